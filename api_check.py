@@ -5,9 +5,11 @@ from prometheus_client import Gauge, CollectorRegistry, push_to_gateway
 from flask import Response, Flask
 from dotenv import load_dotenv
 from pathlib import Path
-import requests
+import asyncio
+import aiohttp
 import yaml
 import os
+from token_manager import TokenManager
 
 # load app
 app = Flask(__name__)
@@ -17,60 +19,81 @@ dotenv_path = Path('.env')
 load_dotenv()
 
 
-headers = {'accept': 'text/plain'}
-verificationTokenUrl = 'https://domain.com/test/v3/signin/StartEmailLogin'
-refreshTokenUrl = 'https://domain.com/test/v3/signin/ConfirmEmailLogin'
-refreshTokenUrlNew = 'https://domain.com/test/v3/RefreshToken'
 email = os.getenv('SIMPLE_EMAIL')
 route = 'debug/who'
 
 
-def refresh_token(account):
-    verificationTokenData = {'email': account, 'application': 0, 'platform': 2}
-    verificationToken = requests.post(verificationTokenUrl, headers=headers, json=verificationTokenData).json()['data']['verificationToken']
-    refreshTokenData = {'email': account, 'code': '000000', 'verificationToken': verificationToken}
-    refreshToken = requests.post(refreshTokenUrl, headers=headers, json=refreshTokenData).json()['data']['refreshToken']
-    with open('file_token', 'w+') as write_token:
-        write_token.write(refreshToken)
-
-
-refresh_token(email)
+# access token is cached in memory and refreshed shortly before it expires, first login happens on first use;
+# the test backend keeps its own refresh token file
+tokens = TokenManager('https://domain.com/test/v3', email, token_file=os.getenv('TOKEN_FILE', 'file_token_test'))
 
 
 def generate_headers():
-    with open('file_token', 'r') as read_token:
-        tokens = requests.post(refreshTokenUrlNew, headers={'accept': 'text/plain'}, json={'refreshToken': read_token.read()}).json()['data']
-        with open('file_token', 'w+') as write_token:
-            write_token.write(tokens['refreshToken'])
-        data = {'accept': 'application/json', 'Authorization': tokens['token']}
-        return data
+    return tokens.headers()
 
 
 registry = CollectorRegistry()
 COUNTER = Gauge('endpoints', 'Base Gauge', ['name', 'env', 'type_instance', 'type_endpoint', 'endpoint'], registry=registry)
 
 
-def monitoring_api(env, type_endpoint, params, debug):
+probe_concurrency = int(os.getenv('PROBE_CONCURRENCY', 50))
+probe_connect_timeout = float(os.getenv('PROBE_CONNECT_TIMEOUT', 3))
+probe_read_timeout = float(os.getenv('PROBE_READ_TIMEOUT', 10))
+# 0 leaves hosts limited only by PROBE_CONCURRENCY, e.g. many url endpoints behind one ingress
+probe_limit_per_host = int(os.getenv('PROBE_LIMIT_PER_HOST', 0))
+sweep = [('prod', 'ip_address'), ('stage', 'ip_address'), ('prod', 'url'), ('stage', 'url')]
+
+
+def probe_timeout(connect, read):
+    # total caps servers that keep trickling bytes, so no probe outlives connect + read
+    return aiohttp.ClientTimeout(total=connect + read, sock_connect=connect, sock_read=read)
+
+
+def build_targets(environments):
+    # every env x type_endpoint combination from list.yaml, read once per sweep
     with open("list.yaml", "r") as stream:
         data = yaml.safe_load(stream)
+    targets = []
+    for env, type_endpoint in environments:
         for service_name in data:
+            timeout = data[service_name].get('timeout', {})
             check_url = data[service_name]['env'][env][type_endpoint]
             for instance, ip in check_url.items():
-                try:
-                    response = requests.get('%s/%s' % (ip, debug), headers=params)
-                    check_result = 1 if response.status_code == 200 else 2 if response.status_code == 401 else 0
-                    COUNTER.labels(name=service_name, env=env, type_instance=instance, type_endpoint=type_endpoint, endpoint=ip).set(int(check_result))
-                except:
-                    COUNTER.labels(name=service_name, env=env, type_instance=instance, type_endpoint=type_endpoint, endpoint=ip).set(int(0))
+                targets.append({'labels': {'name': service_name, 'env': env, 'type_instance': instance,
+                                           'type_endpoint': type_endpoint, 'endpoint': ip},
+                                'url': ip,
+                                'timeout': probe_timeout(timeout.get('connect', probe_connect_timeout),
+                                                         timeout.get('read', probe_read_timeout))})
+    return targets
+
+
+async def probe(session, semaphore, target, params, debug):
+    async with semaphore:
+        try:
+            async with session.get('%s/%s' % (target['url'], debug), headers=params, timeout=target['timeout']) as response:
+                check_result = 1 if response.status == 200 else 2 if response.status == 401 else 0
+        except Exception:
+            check_result = 0
+    COUNTER.labels(**target['labels']).set(int(check_result))
+
+
+async def probe_all(targets, params, debug):
+    # keep-alive connections are shared by all probes of the sweep; the semaphore alone bounds how many run at once
+    # and is taken before the timeout starts, so queued probes are never reported as down
+    semaphore = asyncio.Semaphore(probe_concurrency)
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=probe_limit_per_host)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[probe(session, semaphore, target, params, debug) for target in targets])
+
+
+def monitoring_api(environments, params, debug):
+    asyncio.run(probe_all(build_targets(environments), params, debug))
 
 
 @app.route("/metrics")
 def r_value():
     token_data = generate_headers()
-    monitoring_api('prod', 'ip_address', token_data, route)
-    monitoring_api('stage', 'ip_address', token_data, route)
-    monitoring_api('prod', 'url', token_data, route)
-    monitoring_api('stage', 'url', token_data, route)
+    monitoring_api(sweep, token_data, route)
     push_to_gateway('pushgateway:9091', job='pushgateway', registry=registry)
     return ('Metrics sent to pushgateway')
 
@@ -2,30 +2,144 @@
 
 import argparse
 import CloudFlare
+import gzip
+import hashlib
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 import yaml
 
-# load config
-with open('config.yml', 'r') as yaml_file:
-    config = yaml.safe_load(yaml_file)
+# Cloudflare allows 1200 requests per 5 minutes per token
+CF_REQUESTS_PER_SECOND = 4
+DNS_RECORDS_PER_PAGE = 1000
+DNS_RECORDS_PREFETCH = 4
+BACKUP_RETENTION_DAYS = 30
+ZONE_CACHE_FILE = '.zone_cache.json'
+ZONE_CACHE_TTL = 24 * 60 * 60
+
+config = None
+config_index = {}
+
+
+def load_config(path='config.yml'):
+    # read once and index by name; later calls reuse the parsed config
+    global config, config_index
+    if config is None:
+        with open(path, 'r') as yaml_file:
+            config = yaml.safe_load(yaml_file)
+        config_index = {entry['name']: entry for entry in config}
+    return config
+
 
 def get_zone_info(name):
-    for entry in config:
-        if entry['name'] == name:
-            return entry.get('api_key'), entry.get('zone_name')
-    return None, None
+    load_config()
+    entry = config_index.get(name)
+    if entry is None:
+        return None, None
+    return entry.get('api_key'), entry.get('zone_name')
+
+
+# zone name -> zone id, persisted between runs so warm runs skip the /zones lookup
+zone_cache = None
+zone_cache_lock = threading.Lock()
+
+
+def load_zone_cache():
+    global zone_cache
+    if zone_cache is None:
+        try:
+            with open(ZONE_CACHE_FILE, 'r') as json_file:
+                zone_cache = json.load(json_file)
+        except (OSError, ValueError):
+            zone_cache = {}
+    return zone_cache
+
+
+def save_zone_cache():
+    with open(ZONE_CACHE_FILE + '.tmp', 'w') as json_file:
+        json.dump(zone_cache, json_file)
+    os.replace(ZONE_CACHE_FILE + '.tmp', ZONE_CACHE_FILE)
+
+
+def get_cached_zone_id(zone_name):
+    with zone_cache_lock:
+        entry = load_zone_cache().get(zone_name)
+        if entry and time.time() - entry['time'] < ZONE_CACHE_TTL:
+            return entry['id']
+    return None
+
+
+def cache_zone_id(zone_name, zone_id):
+    with zone_cache_lock:
+        load_zone_cache()[zone_name] = {'id': zone_id, 'time': time.time()}
+        save_zone_cache()
+
+
+def invalidate_zone_id(zone_name):
+    with zone_cache_lock:
+        if load_zone_cache().pop(zone_name, None) is not None:
+            save_zone_cache()
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        # a bucket below one token could never hand one out
+        self.capacity = max(1, capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# one client and one request budget per API token, shared between worker threads
+clients = {}
+buckets = {}
+clients_lock = threading.Lock()
+
+
+def get_client(api_key, raw=False):
+    with clients_lock:
+        if (api_key, raw) not in clients:
+            clients[(api_key, raw)] = CloudFlare.CloudFlare(token=api_key, raw=raw)
+        if api_key not in buckets:
+            buckets[api_key] = TokenBucket(CF_REQUESTS_PER_SECOND)
+        return clients[(api_key, raw)]
 
-def backup_dns_records(domain_name, backup_name):
+
+def throttle(api_key):
+    get_client(api_key)
+    buckets[api_key].acquire()
+
+
+def get_zone(domain_name):
     api_key, zone_name = get_zone_info(domain_name)
 
     if api_key is None or zone_name is None:
         exit(f'Configuration not found for domain: {domain_name}')
 
-    cf = CloudFlare.CloudFlare(token=api_key)
+    cf = get_client(api_key)
+
+    zone_id = get_cached_zone_id(zone_name)
+    if zone_id is not None:
+        return cf, api_key, zone_name, zone_id
 
     try:
+        throttle(api_key)
         zones = cf.zones.get(params={'name': zone_name, 'per_page': 1})
     except CloudFlare.exceptions.CloudFlareAPIError as e:
         exit(f'/zones.get {e} - API call failed')
@@ -35,215 +149,480 @@ def backup_dns_records(domain_name, backup_name):
     if len(zones) == 0:
         exit(f'No zones found for domain: {domain_name}')
 
-    zone = zones[0]
-    zone_id = zone['id']
+    cache_zone_id(zone_name, zones[0]['id'])
+    return cf, api_key, zone_name, zones[0]['id']
+
 
+def call_zone(domain_name, call, description):
+    # a cached zone id goes stale when the zone is re-created or moved, so a failed call is retried once after a fresh lookup
+    zone = get_zone(domain_name)
     try:
-        dns_records = cf.zones.dns_records.get(zone_id)
+        return zone, call(*zone)
     except CloudFlare.exceptions.CloudFlareAPIError as e:
-        exit(f'/zones/dns_records.get {e} - API call failed')
+        invalidate_zone_id(zone[2])
+        fresh_zone = get_zone(domain_name)
+        if fresh_zone[3] == zone[3]:
+            exit(f'{description} {e} - API call failed')
 
-    # Create a list to store DNS records
-    dns_records_list = []
+    try:
+        return fresh_zone, call(*fresh_zone)
+    except CloudFlare.exceptions.CloudFlareAPIError as e:
+        invalidate_zone_id(fresh_zone[2])
+        exit(f'{description} {e} - API call failed')
 
-    for dns_record in dns_records:
-        r_name = dns_record['name']
-        r_type = dns_record['type']
-        r_value = dns_record['content']
-        r_id = dns_record['id']
-        r_proxied = dns_record['proxied']
-        dns_records_list.append({'id': r_id, 'name': r_name, 'type': r_type, 'value': r_value, 'proxied': r_proxied})
 
-    # Create a folder for backups if it doesn't exist
-    backup_folder = os.path.join('backups', domain_name)
-    if not os.path.exists(backup_folder):
-        os.makedirs(backup_folder)
+def iter_dns_records(api_key, zone_id, per_page=DNS_RECORDS_PER_PAGE, prefetch=DNS_RECORDS_PREFETCH):
+    cf = get_client(api_key, raw=True)
 
-    # Create a filename for the backup
-    current_datetime = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
-    backup_filename = f'{backup_name}_{current_datetime}.json'
+    def get_page(page):
+        throttle(api_key)
+        return cf.zones.dns_records.get(zone_id, params={'page': page, 'per_page': per_page})
 
-    backup_file_path = os.path.join(backup_folder, backup_filename)
+    first = get_page(1)
+    yield from first['result']
+    total_pages = first['result_info'].get('total_pages') or 1
 
-    # Save the DNS records to a JSON file
-    with open(backup_file_path, 'w') as json_file:
-        json.dump(dns_records_list, json_file, indent=4)
+    # keep the next few pages in flight while the caller consumes the current one
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        pending = {}
+        next_page = 2
+        for page in range(2, total_pages + 1):
+            while next_page <= total_pages and next_page < page + prefetch:
+                pending[next_page] = executor.submit(get_page, next_page)
+                next_page += 1
+            yield from pending.pop(page).result()['result']
 
-    print(f'DNS records from {zone_name} zone backed up to {backup_filename}')
 
-    # Delete old backups (older than 30 days)
-    thirty_days_ago = datetime.now() - timedelta(days=30)
-    for backup_file in os.listdir(backup_folder):
-        file_parts = os.path.splitext(backup_file)[0].split('_')
-        if len(file_parts) >= 2:
-            file_datetime_str = "_".join(file_parts[1:])
-            file_datetime = datetime.strptime(file_datetime_str, '%Y_%m_%d_%H_%M_%S')
-            if file_datetime < thirty_days_ago:
-                file_path = os.path.join(backup_folder, backup_file)
-                os.remove(file_path)
+def load_index(backup_folder):
+    index_path = os.path.join(backup_folder, 'index.json')
+    if not os.path.exists(index_path):
+        return {'snapshots': [], 'refs': {}}
+    with open(index_path, 'r') as json_file:
+        return json.load(json_file)
 
 
-def restore_dns_records(domain_name, backup_name, input_file):
-    api_key, zone_name = get_zone_info(domain_name)
+def save_index(backup_folder, index):
+    index_path = os.path.join(backup_folder, 'index.json')
+    with open(index_path + '.tmp', 'w') as json_file:
+        json.dump(index, json_file)
+    os.replace(index_path + '.tmp', index_path)
+
+
+OBJECT_EXTENSIONS = {'json': 'json.gz', 'bind': 'zone.gz'}
+
+
+def object_path(backup_folder, digest, fmt='json'):
+    return os.path.join(backup_folder, 'objects', f'{digest}.{OBJECT_EXTENSIONS[fmt]}')
 
-    if api_key is None or zone_name is None:
-        exit(f'Configuration not found for domain: {domain_name}')
 
-    cf = CloudFlare.CloudFlare(token=api_key)
+def json_array_chunks(records):
+    empty = True
+    for record in records:
+        yield ('[\n' if empty else ',\n') + json.dumps(record, sort_keys=True)
+        empty = False
+    yield '[]\n' if empty else '\n]\n'
 
+
+def write_object(backup_folder, chunks, fmt='json'):
+    # content is hashed uncompressed and only kept if no snapshot already has the same content
+    os.makedirs(os.path.join(backup_folder, 'objects'), exist_ok=True)
+    tmp_file_path = os.path.join(backup_folder, 'objects', f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    sha256 = hashlib.sha256()
     try:
-        zones = cf.zones.get(params={'name': zone_name, 'per_page': 1})
-    except CloudFlare.exceptions.CloudFlareAPIError as e:
-        exit(f'/zones.get {e} - API call failed')
-    except Exception as e:
-        exit(f'/zones.get - {e} - API call failed')
+        with gzip.open(tmp_file_path, 'wt') as object_file:
+            for chunk in chunks:
+                sha256.update(chunk.encode())
+                object_file.write(chunk)
+    except BaseException:
+        os.remove(tmp_file_path)
+        raise
+
+    digest = sha256.hexdigest()
+    if os.path.exists(object_path(backup_folder, digest, fmt)):
+        os.remove(tmp_file_path)
+    else:
+        os.replace(tmp_file_path, object_path(backup_folder, digest, fmt))
+    return digest
+
+
+def prune_snapshots(backup_folder, index, days=BACKUP_RETENTION_DAYS):
+    # snapshots are kept oldest first, so expired ones are always at the front; the latest is never pruned
+    cutoff = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%S')
+    while len(index['snapshots']) > 1 and index['snapshots'][0]['time'] < cutoff:
+        snapshot = index['snapshots'].pop(0)
+        digest = snapshot['hash']
+        index['refs'][digest] -= 1
+        if index['refs'][digest] == 0:
+            del index['refs'][digest]
+            os.remove(object_path(backup_folder, digest, snapshot.get('format', 'json')))
+
+
+def export_zone_file(cf, api_key, zone_id):
+    # the export header carries the export time; dropping it keeps unchanged zones deduplicated
+    throttle(api_key)
+    zone_file = cf.zones.dns_records.export.get(zone_id)
+    return [line + '\n' for line in zone_file.splitlines() if not line.startswith(';;')]
+
+
+def backup_dns_records(domain_name, backup_name, fmt='json'):
+    # Create a folder for backups if it doesn't exist
+    backup_folder = os.path.join('backups', domain_name)
+    if not os.path.exists(backup_folder):
+        os.makedirs(backup_folder)
 
-    if len(zones) == 0:
-        exit(f'No zones found for domain: {domain_name}')
+    records_count = 0
+
+    def records(api_key, zone_id):
+        nonlocal records_count
+        for dns_record in iter_dns_records(api_key, zone_id):
+            r_name = dns_record['name']
+            r_type = dns_record['type']
+            r_value = dns_record['content']
+            r_id = dns_record['id']
+            r_proxied = dns_record['proxied']
+            r_ttl = dns_record['ttl']
+            records_count += 1
+            record = {'id': r_id, 'name': r_name, 'type': r_type, 'value': r_value, 'proxied': r_proxied, 'ttl': r_ttl}
+            # MX/URI priority and the structured SRV/CAA fields are needed to recreate those records
+            for key in OPTIONAL_ATTRIBUTES:
+                if dns_record.get(key) is not None:
+                    record[key] = dns_record[key]
+            yield record
+
+    # Stream the DNS records (or the exported zone file) into the content-addressed store
+    def snapshot(cf, api_key, zone_name, zone_id):
+        nonlocal records_count
+        records_count = 0
+        if fmt == 'bind':
+            lines = export_zone_file(cf, api_key, zone_id)
+            records_count = sum(1 for line in lines if line.strip() and not line.startswith(';'))
+            return write_object(backup_folder, lines, fmt)
+        return write_object(backup_folder, json_array_chunks(records(api_key, zone_id)), fmt)
+
+    (cf, api_key, zone_name, zone_id), digest = call_zone(domain_name, snapshot, '/zones/dns_records')
+
+    index = load_index(backup_folder)
+    index['snapshots'].append({'name': backup_name, 'time': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+                               'hash': digest, 'format': fmt, 'records': records_count})
+    index['refs'][digest] = index['refs'].get(digest, 0) + 1
+
+    # Delete old snapshots (older than 30 days)
+    prune_snapshots(backup_folder, index)
+    save_index(backup_folder, index)
+
+    print(f'DNS records from {zone_name} zone backed up to snapshot {digest[:12]}')
+
+    return records_count
+
+
+def load_records(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as json_file:
+        return json.load(json_file)
+
+
+OPTIONAL_ATTRIBUTES = ('priority', 'data')
+
+
+def record_data(record):
+    # backups store the record content as 'value', the API calls it 'content'
+    data = {
+        'name': record['name'],
+        'type': record['type'],
+        'content': record['content'] if 'content' in record else record['value'],
+        'proxied': record.get('proxied', False),
+    }
+    for key in ('ttl',) + OPTIONAL_ATTRIBUTES:
+        if key in record:
+            data[key] = record[key]
+    return data
+
+
+def index_records(records):
+    index = {}
+    for record in records:
+        data = record_data(record)
+        if 'id' in record:
+            data['id'] = record['id']
+        index.setdefault((data['name'], data['type'], data['content']), []).append(data)
+    return index
+
+
+def attributes_differ(current, backup):
+    if current['proxied'] != backup['proxied']:
+        return True
+    # older backups lack some attributes, those are only compared when both sides have them
+    return any(key in current and key in backup and current[key] != backup[key] for key in ('ttl',) + OPTIONAL_ATTRIBUTES)
+
+
+def diff_records(current_records, backup_records):
+    current_index = index_records(current_records)
+    backup_index = index_records(backup_records)
+
+    added = []
+    changed = []
+    removed = []
+    for key, backups in backup_index.items():
+        currents = current_index.get(key, [])
+        for current, backup in zip(currents, backups):
+            if attributes_differ(current, backup):
+                changed.append({'current': current, 'backup': backup})
+        added.extend(currents[len(backups):])
+        removed.extend(backups[len(currents):])
+    for key, currents in current_index.items():
+        if key not in backup_index:
+            added.extend(currents)
+
+    return {'added': added, 'changed': changed, 'removed': removed}
+
+
+def plan_restore(live_records, backup_records):
+    diff = diff_records(live_records, backup_records)
+    updates = [(change['current']['id'], change['backup']) for change in diff['changed']]
+
+    # a changed value of an existing name/type is rewritten in place instead of delete + create
+    deletes_by_name = {}
+    for record in diff['added']:
+        deletes_by_name.setdefault((record['name'], record['type']), []).append(record)
+    creates = []
+    for data in diff['removed']:
+        candidates = deletes_by_name.get((data['name'], data['type']))
+        if candidates:
+            updates.append((candidates.pop()['id'], data))
+        else:
+            creates.append(data)
+    deletes = [record for candidates in deletes_by_name.values() for record in candidates]
+
+    # ids stored in a backup are stale and must not be sent back to the API
+    updates = [(record_id, {k: v for k, v in data.items() if k != 'id'}) for record_id, data in updates]
+    creates = [{k: v for k, v in data.items() if k != 'id'} for data in creates]
+
+    return {'create': creates, 'update': updates, 'delete': deletes}
+
+
+def print_plan(zone_name, plan):
+    for data in plan['create']:
+        print(f'+ create {data["name"]} ({data["type"]}, {data["content"]}, proxied={data["proxied"]})')
+    for record_id, data in plan['update']:
+        print(f'~ update {data["name"]} ({data["type"]}, {data["content"]}, proxied={data["proxied"]}) [{record_id}]')
+    for record in plan['delete']:
+        print(f'- delete {record["name"]} ({record["type"]}, {record["content"]}) [{record["id"]}]')
+    print(f'{zone_name}: {len(plan["create"])} to create, {len(plan["update"])} to update, {len(plan["delete"])} to delete')
 
-    zone = zones[0]
-    zone_id = zone['id']
 
+def apply_plan(cf, api_key, zone_id, plan, workers=8):
+    def call(action, *args, data=None):
+        try:
+            throttle(api_key)
+            if data is None:
+                action(zone_id, *args)
+            else:
+                action(zone_id, *args, data=data)
+            return None
+        except CloudFlare.exceptions.CloudFlareAPIError as e:
+            return f'{e}'
+
+    phases = [
+        [(cf.zones.dns_records.put, (record_id,), data, f'update {data["name"]}') for record_id, data in plan['update']],
+        [(cf.zones.dns_records.delete, (record['id'],), None, f'delete {record["name"]}') for record in plan['delete']],
+        [(cf.zones.dns_records.post, (), data, f'create {data["name"]}') for data in plan['create']],
+    ]
+
+    # phases run one after another so creates don't collide with records that are being replaced
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for phase in phases:
+            futures = [(executor.submit(call, action, *args, data=data), description)
+                       for action, args, data, description in phase]
+            for future, description in futures:
+                error = future.result()
+                if error:
+                    failed += 1
+                    print(f'Failed to {description}: {error}')
+    return failed
+
+
+def import_zone_file(domain_name, input_file):
+    opener = gzip.open if input_file.endswith('.gz') else open
+    with opener(input_file, 'rb') as zone_file:
+        content = zone_file.read()
+
+    def post(cf, api_key, zone_name, zone_id):
+        # the import endpoint only adds records, so on a non-empty zone changed or new records would survive or clash
+        if next(iter_dns_records(api_key, zone_id, per_page=1, prefetch=1), None) is not None:
+            exit(f'{zone_name} zone is not empty; a BIND restore only adds records, use a JSON backup to restore it')
+        throttle(api_key)
+        return cf.zones.dns_records.import_.post(zone_id, files={'file': ('zone.txt', content)})
+
+    (cf, api_key, zone_name, zone_id), result = call_zone(domain_name, post, '/zones/dns_records/import')
+
+    print(f'DNS records in {zone_name} zone imported from {input_file} '
+          f'({result.get("recs_added")} of {result.get("total_records_parsed")} records added)')
+
+
+def restore_dns_records(domain_name, backup_name, input_file, plan_only=False, workers=8, fmt='json'):
     # Load DNS records from the input JSON file
     if not os.path.exists(input_file):
         exit(f'Backup file {input_file} does not exist.')
 
-    with open(input_file, 'r') as json_file:
-        dns_records_list = json.load(json_file)
+    if fmt == 'bind':
+        if plan_only:
+            exit('--plan is not supported with --format bind')
+        import_zone_file(domain_name, input_file)
+        return
 
-    # Delete existing DNS records in the zone
-    dns_records = cf.zones.dns_records.get(zone_id)
-    for dns_record in dns_records:
-        dns_record_id = dns_record['id']
-        try:
-            cf.zones.dns_records.delete(zone_id, dns_record_id)
-        except CloudFlare.exceptions.CloudFlareAPIError as e:
-            print(f'Failed to delete DNS record {dns_record_id}: {e}')
+    dns_records_list = load_records(input_file)
 
-    # Create DNS records from the input file
-    for dns_record_data in dns_records_list:
-        try:
-            cf.zones.dns_records.post(
-                zone_id,
-                data={
-                    'name': dns_record_data['name'],
-                    'type': dns_record_data['type'],
-                    'content': dns_record_data['value'],
-                    'proxied': dns_record_data['proxied'],
-                },
-            )
-        except CloudFlare.exceptions.CloudFlareAPIError as e:
-            print(f'Failed to create DNS record: {e}')
+    (cf, api_key, zone_name, zone_id), dns_records = call_zone(
+        domain_name, lambda cf, api_key, zone_name, zone_id: list(iter_dns_records(api_key, zone_id)), '/zones/dns_records.get')
 
-    print(f'DNS records in {zone_name} zone restored from {input_file}')
+    plan = plan_restore(dns_records, dns_records_list)
+    print_plan(zone_name, plan)
+    if plan_only:
+        return
 
+    failed = apply_plan(cf, api_key, zone_id, plan, workers)
 
+    print(f'DNS records in {zone_name} zone restored from {input_file} ({failed} failed)')
 
-def check_dns_records(domain_name, backup_name):
-    api_key, zone_name = get_zone_info(domain_name)
 
-    if api_key is None or zone_name is None:
-        exit(f'Configuration not found for domain: {domain_name}')
+def latest_backup(domain_name, backup_name):
+    backup_folder = os.path.join('backups', domain_name)
+    for snapshot in reversed(load_index(backup_folder)['snapshots']):
+        if snapshot['name'] == backup_name and snapshot.get('format', 'json') == 'json':
+            return load_records(object_path(backup_folder, snapshot['hash']))
+    exit(f'No backup snapshots found for {backup_name} in {backup_folder}')
 
-    cf = CloudFlare.CloudFlare(token=api_key)
 
-    try:
-        zones = cf.zones.get(params={'name': zone_name, 'per_page': 1})
-    except CloudFlare.exceptions.CloudFlareAPIError as e:
-        exit(f'/zones.get {e} - API call failed')
-    except Exception as e:
-        exit(f'/zones.get - {e} - API call failed')
+def diff_zone(domain_name, backup_name):
+    _, dns_records = call_zone(
+        domain_name, lambda cf, api_key, zone_name, zone_id: list(iter_dns_records(api_key, zone_id)), '/zones/dns_records.get')
 
-    if len(zones) == 0:
-        exit(f'No zones found for domain: {domain_name}')
+    return diff_records(dns_records, latest_backup(domain_name, backup_name))
 
-    zone = zones[0]
-    zone_id = zone['id']
 
-    try:
-        dns_records = cf.zones.dns_records.get(zone_id)
-    except CloudFlare.exceptions.CloudFlareAPIError as e:
-        exit(f'/zones/dns_records.get {e} - API call failed')
+def print_diff(domain_name, diff):
+    if 'error' in diff:
+        print(f'{domain_name}: {diff["error"]}')
+        return
 
-    backup_folder = os.path.join('backups', domain_name)
-    backup_files = [f for f in os.listdir(backup_folder) if f.startswith(backup_name) and f.endswith('.json')]
-    if not backup_files:
-        exit(f'No backup files found for {backup_name} in {backup_folder}')
+    if diff['added'] or diff['changed'] or diff['removed']:
+        print(f'{domain_name}:')
 
-    latest_backup_file = max(backup_files)
+    if diff['added']:
+        print('Added records:')
+        for record in diff['added']:
+            print(f'Added: {record["name"]} ({record["type"]}, {record["content"]})')
+
+    if diff['changed']:
+        print('Changed records:')
+        for change in diff['changed']:
+            current, backup = change['current'], change['backup']
+            print(f'Changed: {current["name"]} ({current["type"]}, {current["content"]}, '
+                  f'proxied {backup["proxied"]} -> {current["proxied"]}, ttl {backup.get("ttl")} -> {current.get("ttl")}, '
+                  f'priority {backup.get("priority")} -> {current.get("priority")})')
+
+    if diff['removed']:
+        print('Removed records:')
+        for record in diff['removed']:
+            print(f'Removed: {record["name"]} ({record["type"]}, {record["content"]})')
 
-    with open(os.path.join(backup_folder, latest_backup_file), 'r') as json_file:
-        latest_dns_records_list = json.load(json_file)
+    if not diff['added'] and not diff['changed'] and not diff['removed']:
+        print(f'No differences found between current DNS records of {domain_name} and the latest backup.')
 
-    latest_dns_records_dict = {(record['name'], record['type']): record for record in latest_dns_records_list}
 
-    added_records = []
-    updated_records = []
-    removed_records = []
+def check_dns_records(domain_name, backup_name, output='text'):
+    diff = diff_zone(domain_name, backup_name)
+    if output == 'json':
+        print(json.dumps({domain_name: diff}, indent=2))
+    else:
+        print_diff(domain_name, diff)
 
-    for dns_record in dns_records:
-        r_name = dns_record['name']
-        r_type = dns_record['type']
-        r_value = dns_record['content']
-        key = (r_name, r_type)
 
-        if key in latest_dns_records_dict:
-            latest_record = latest_dns_records_dict[key]
-            if latest_record['value'] != r_value:
-                updated_records.append(f'Updated: {r_name} ({r_type} -> {latest_record["type"]}, {r_value} -> {latest_record["value"]})')
-        else:
-            added_records.append(f'Added: {r_name} ({r_type}, {r_value})')
+def backup_zone_timed(domain_name, fmt='json'):
+    start = time.monotonic()
+    try:
+        records = backup_dns_records(domain_name, domain_name, fmt)
+        status = 'ok'
+    except SystemExit as e:
+        records = 0
+        status = str(e.code)
+    except Exception as e:
+        records = 0
+        status = f'error: {e}'
+    return domain_name, records, time.monotonic() - start, status
 
-    for (name, record_type), record in latest_dns_records_dict.items():
-        key = (name, record_type)
-        if key not in {(dns_record['name'], dns_record['type']) for dns_record in dns_records}:
-            removed_records.append(f'Removed: {name} ({record_type}, {record["value"]})')
 
-    if added_records:
-        print('Added records:')
-        for record in added_records:
-            print(record)
+def print_summary(results):
+    width = max([len('Zone')] + [len(name) for name, _, _, _ in results])
+    print(f'{"Zone":<{width}}  {"Records":>8}  {"Seconds":>8}  Status')
+    for name, records, elapsed, status in sorted(results, key=lambda result: result[2], reverse=True):
+        print(f'{name:<{width}}  {records:>8}  {elapsed:>8.2f}  {status}')
+    failed = sum(1 for result in results if result[3] != 'ok')
+    print(f'{len(results)} zones backed up, {failed} failed')
 
-    if updated_records:
-        print('Updated records:')
-        for record in updated_records:
-            print(record)
 
-    if removed_records:
-        print('Removed records:')
-        for record in removed_records:
-            print(record)
+def backup_all_domains(workers=8, fmt='json'):
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(backup_zone_timed, entry['name'], fmt) for entry in load_config()]
+        for future in as_completed(futures):
+            results.append(future.result())
+    print_summary(results)
 
-    if not added_records and not updated_records and not removed_records:
-        print('No differences found between current DNS records and the latest backup.')
 
-def backup_all_domains():
-    for entry in config:
-        backup_dns_records(entry['name'], entry['name'])
+def diff_zone_safe(domain_name):
+    try:
+        return domain_name, diff_zone(domain_name, domain_name)
+    except SystemExit as e:
+        return domain_name, {'error': str(e.code)}
+    except Exception as e:
+        return domain_name, {'error': f'{e}'}
+
+
+def check_all_domains(output='text', workers=8):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        diffs = dict(executor.map(diff_zone_safe, [entry['name'] for entry in load_config()]))
 
-def check_all_domains():
-    for entry in config:
-        check_dns_records(entry['name'], entry['name'])
+    if output == 'json':
+        # unchanged zones are left out so the report only grows with the number of changes
+        print(json.dumps({name: diff for name, diff in diffs.items()
+                          if 'error' in diff or diff['added'] or diff['changed'] or diff['removed']}, indent=2))
+    else:
+        for name, diff in diffs.items():
+            print_diff(name, diff)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Cloudflare DNS Management Script')
     parser.add_argument('--backup', action='store_true', help='Create a DNS records backup')
     parser.add_argument('--restore', action='store_true', help='Restore DNS records to the same account')
     parser.add_argument('--name', type=str, help='Specify the name of the backup or domain for restore/check')
-    parser.add_argument('--path-to-restore', type=str, help='Specify the path to the backup file for restore')
+    parser.add_argument('--path-to-restore', type=str, help='Specify the path to the backup file (.json or snapshot .json.gz) for restore')
     parser.add_argument('--check', action='store_true', help='Check DNS records against the latest backup')
     parser.add_argument('--all', action='store_true', help='Backup/Restore/Check all domains in the configuration')
+    parser.add_argument('--workers', type=int, default=8, help='Number of zones (or restore API calls) to run in parallel')
+    parser.add_argument('--plan', action='store_true', help='Only print the changes a restore would make')
+    parser.add_argument('--format', choices=['json', 'bind'], default='json', help='Backup/restore records as JSON or as a BIND zone file (BIND restores only into an empty zone)')
+    parser.add_argument('--output', choices=['text', 'json'], default='text', help='Output format for --check')
+    parser.add_argument('--rate', type=float, default=CF_REQUESTS_PER_SECOND, help='API requests per second allowed per token')
 
     args = parser.parse_args()
+    if args.rate <= 0:
+        parser.error('--rate must be greater than 0')
+    CF_REQUESTS_PER_SECOND = args.rate
 
     if args.backup and args.name:
-        backup_dns_records(args.name, args.name)
+        backup_dns_records(args.name, args.name, args.format)
 
     if args.restore and args.name and args.path_to_restore:
-        restore_dns_records(args.name, args.name, args.path_to_restore)
+        restore_dns_records(args.name, args.name, args.path_to_restore, args.plan, args.workers, args.format)
 
     if args.check and args.name:
-        check_dns_records(args.name, args.name)
+        check_dns_records(args.name, args.name, args.output)
 
     if args.all:
-        backup_all_domains()
+        if args.check:
+            check_all_domains(args.output, args.workers)
+        else:
+            backup_all_domains(args.workers, args.format)
+
@@ -1,32 +1,227 @@
 #!/usr/bin/env python3
 
+import argparse
 import requests
 import json
 import os
 import re
+import sqlite3
+import threading
+import time
 import yaml
-import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from pathlib import Path
-from git import Repo
+from git import Repo, GitCommandError
 from git.remote import RemoteProgress
 
 dotenv_path = Path('.env')
 load_dotenv()
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+REGEX_IMAGE_NAME = re.compile(r'(?:\w+\.\w+\.\w+\/)?([^:]+)(?::.+)?')
+REGEX_DOCKER_TAG = re.compile(r'((?P<tag>[\w.\-_]{1,127})|)$')
+MANIFEST_LIST_TYPES = ('application/vnd.docker.distribution.manifest.list.v2+json',
+                       'application/vnd.oci.image.index.v1+json')
+
+
+def parse_image(image, parsed):
+    for image_name, docker_tag in zip(REGEX_IMAGE_NAME.findall(image), REGEX_DOCKER_TAG.findall(image)):
+        parsed[image_name] = docker_tag[0]
+
+
+def pod_specs(document):
+    spec = document.get('spec') or {}
+    if document.get('kind') == 'CronJob':
+        spec = (spec.get('jobTemplate') or {}).get('spec') or {}
+    if document.get('kind') != 'Pod':
+        spec = (spec.get('template') or {}).get('spec') or {}
+    return spec
+
+
+def parse_k8s_manifest(deployment):
+    parsed = {}
+    with open(deployment, "r") as stream:
+        for document in yaml.load_all(stream, Loader=SafeLoader):
+            if not isinstance(document, dict):
+                continue
+            spec = pod_specs(document)
+            for get_image in (spec.get('initContainers') or []) + (spec.get('containers') or []):
+                if isinstance(get_image, dict) and isinstance(get_image.get('image'), str):
+                    parse_image(get_image['image'], parsed)
+    return parsed
+
+
+def parse_compose_manifest(deployment):
+    parsed = {}
+    with open(deployment, "r") as stream:
+        for document in yaml.load_all(stream, Loader=SafeLoader):
+            if isinstance(document, list):
+                services = document
+            elif isinstance(document, dict):
+                services = document.get('services') or []
+                services = list(services.values()) if isinstance(services, dict) else services
+            else:
+                continue
+            for get_image in services:
+                if isinstance(get_image, dict) and isinstance(get_image.get('image'), str):
+                    parse_image(get_image['image'], parsed)
+    return parsed
+
+
+def parse_manifest(job):
+    path, kind = job
+    try:
+        return path, (parse_k8s_manifest if kind == 'k8s' else parse_compose_manifest)(path)
+    except (OSError, yaml.YAMLError) as e:
+        print('Failed to parse %s: %s' % (path, e))
+        return path, {}
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Inventory:
+    # local snapshot of the registry, refreshed only for repositories whose lastUpdateTime changed
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        has_references = self.db.execute("select 1 from sqlite_master where name = 'refs'").fetchone()
+        self.db.executescript('''
+            create table if not exists repos (name text primary key, last_update text);
+            create table if not exists tags (repo text, tag text, position integer, primary key (repo, tag));
+            create table if not exists manifests (repo text, digest text, size integer, media_type text,
+                                                  tags text, last_update text, primary key (repo, digest));
+            create table if not exists refs (repo text, parent text, child text);
+            create index if not exists refs_repo on refs (repo);
+        ''')
+        if not has_references:
+            # inventories written before manifest list references were tracked are refetched once
+            self.invalidate([name for name, in self.db.execute('select name from repos')])
+
+    def repo_updates(self):
+        return dict(self.db.execute('select name, last_update from repos'))
+
+    def replace_repo(self, name, last_update, tags, manifests, references):
+        with self.db:
+            self.db.execute('delete from tags where repo = ?', (name,))
+            self.db.execute('delete from manifests where repo = ?', (name,))
+            self.db.execute('delete from refs where repo = ?', (name,))
+            self.db.executemany('insert into refs values (?, ?, ?)', [
+                (name, parent, child) for parent, children in references.items() for child in children])
+            self.db.executemany('insert into tags values (?, ?, ?)',
+                                [(name, tag, position) for position, tag in enumerate(tags)])
+            self.db.executemany('insert into manifests values (?, ?, ?, ?, ?, ?)', [
+                (name, manifest['digest'], manifest.get('imageSize', 0), manifest.get('mediaType'),
+                 json.dumps(manifest.get('tags') or []), manifest.get('lastUpdateTime')) for manifest in manifests])
+            self.db.execute('insert or replace into repos values (?, ?)', (name, last_update))
+
+    def remove_repos(self, names):
+        with self.db:
+            for name in names:
+                self.db.execute('delete from repos where name = ?', (name,))
+                self.db.execute('delete from tags where repo = ?', (name,))
+                self.db.execute('delete from manifests where repo = ?', (name,))
+                self.db.execute('delete from refs where repo = ?', (name,))
+
+    def invalidate(self, names):
+        with self.db:
+            self.db.executemany('update repos set last_update = null where name = ?', [(name,) for name in names])
+
+    def tags(self):
+        repos = {name: [] for name, in self.db.execute('select name from repos')}
+        for repo, tag in self.db.execute('select repo, tag from tags order by repo, position'):
+            repos[repo].append(tag)
+        return repos
+
+    def manifests(self, repo):
+        return [{'digest': digest, 'imageSize': size, 'mediaType': media_type, 'tags': json.loads(tags),
+                 'lastUpdateTime': last_update}
+                for digest, size, media_type, tags, last_update in self.db.execute(
+                    'select digest, size, media_type, tags, last_update from manifests where repo = ?', (repo,))]
+
+    def references(self, repo):
+        children = {}
+        for parent, child in self.db.execute('select parent, child from refs where repo = ?', (repo,)):
+            children.setdefault(parent, []).append(child)
+        return children
+
+
+class GCPlanner:
+    # mark every manifest reachable from a kept tag (through manifest lists), sweep the rest
+    def __init__(self, inventory):
+        self.inventory = inventory
+
+    def plan_repo(self, repo_name, kept_tags):
+        manifests = self.inventory.manifests(repo_name)
+        children = self.inventory.references(repo_name)
+        tag_digest = {tag: manifest['digest'] for manifest in manifests for tag in manifest['tags']}
+
+        marked = set()
+        stack = [tag_digest[tag] for tag in kept_tags if tag in tag_digest]
+        while stack:
+            digest = stack.pop()
+            if digest not in marked:
+                marked.add(digest)
+                stack.extend(children.get(digest, ()))
+
+        # unmarked manifests go away in one call together with their tags,
+        # deleted tags on marked manifests are only untagged
+        tags = []
+        digests = []
+        size = 0
+        for manifest in manifests:
+            if manifest['digest'] in marked:
+                tags.extend(tag for tag in manifest['tags'] if tag not in kept_tags)
+            else:
+                digests.append(manifest['digest'])
+                size += manifest['imageSize'] or 0
+        return {'tags': tags, 'digests': digests, 'bytes': size}
+
+    def plan(self, keep_tags):
+        return {repo_name: self.plan_repo(repo_name, kept_tags) for repo_name, kept_tags in keep_tags.items()}
+
 
 class DevOpsScript:
-    def __init__(self):
+    def __init__(self, crawl=True, offline=False):
         self.registry = os.getenv('ENDPOINT')
         self.creds = os.getenv('AUTH')
         self.auth = {'Content-Type': 'application/json', 'Authorization': 'Basic %s' % self.creds}
         self.params = {'n': 5000}
-        self.regex_image_name = '(?:\w+\.\w+\.\w+\/)?([^:]+)(?::.+)?'
-        self.regex_docker_tag = '((?P<tag>[\w.\-_]{1,127})|)$'
-        self.extensions = ['*.yml', '*.yaml']
-        self.depth = ['*', '*/*']
-        self.registry_array = self.get_repos_with_tags(self.registry, self.auth, self.params)
-        self.prod_array = self.join_dict_to_dict()
+        self.extensions = ('.yml', '.yaml')
+        self.depth = 2
+        self.manifest_cache = os.getenv('MANIFEST_CACHE', '.manifest_cache.json')
+        self.deploy_state = os.getenv('DEPLOY_STATE', '.deploy_state.json')
+        self.workers = int(os.getenv('WORKERS', 16))
+        self.session = self.create_session()
+        self.limiter = RateLimiter(float(os.getenv('DELETE_RATE', 10)))
+        self.checkpoint = os.getenv('CHECKPOINT', 'cleanup_checkpoint.json')
+        self.checkpoint_max_age = float(os.getenv('CHECKPOINT_MAX_AGE_HOURS', 12)) * 3600
+        self.inventory = Inventory(os.getenv('INVENTORY', 'registry_inventory.db'))
+        if crawl:
+            if offline:
+                self.registry_array = self.inventory.tags()
+            else:
+                self.registry_array = self.get_repos_with_tags(self.registry, self.auth, self.params)
+            self.prod_array = self.join_dict_to_dict()
 
     class Progress(RemoteProgress):
         def line_dropped(self, line):
@@ -35,135 +230,382 @@ class DevOpsScript:
         def update(self, *args):
             print(self._cur_line)
 
+    def create_session(self):
+        # one keep-alive pool shared by all worker threads, retrying throttled and failed calls with backoff
+        retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=None, respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        return session
+
+    def get_pages(self, url, headers, params=None):
+        while url:
+            with self.session.get(url, headers=headers, params=params) as data:
+                answer = json.loads(data.text)
+                next_page = data.links.get('next', {}).get('url')
+            yield answer
+            # the Link header carries the full query of the next page
+            url = urljoin(url, next_page) if next_page else None
+            params = None
+
     def pull_repo(self):
+        def pull(git_folders, private_keys):
+            repo = Repo(git_folders)
+            with repo.git.custom_environment(GIT_SSH_COMMAND=private_keys):
+                repo.remotes.origin.pull(progress=self.Progress())
+
         with open('info.yaml', "r") as stream:
             vars_yaml = yaml.safe_load(stream)
-            for git_folders, private_keys in zip(vars_yaml['vars']['folders'], vars_yaml['vars']['keys']):
-                repo = Repo(git_folders)
-                with repo.git.custom_environment(GIT_SSH_COMMAND=private_keys):
-                    repo.remotes.origin.pull(progress=self.Progress())
-
-    def k8s_yaml_parser(self, deployment):
-        parsed = {}
-        if os.path.isfile(deployment):
-            with open(deployment, "r") as stream:
-                deployment = yaml.safe_load(stream)
-                for get_image in deployment['spec']['template']['spec']['containers']:
-                    try:
-                        image = get_image['image']
-                        for image_name, docker_tag in zip(re.findall(self.regex_image_name, image),
-                                                          re.findall(self.regex_docker_tag, image)):
-                            parsed[image_name] = docker_tag[0]
-                    except:
-                        continue
-        return parsed
-
-    @staticmethod
-    def docker_yaml_parser(deployment):
-        parsed = {}
-        if os.path.isfile(deployment):
-            with open(deployment, "r") as stream:
-                deployment = yaml.safe_load(stream)
-                services = deployment if isinstance(deployment, list) else deployment.get('services', [])
-                for get_image in services:
-                    try:
-                        image = get_image.get('image', '')
-                        for image_name, docker_tag in zip(re.findall(DevOpsScript.regex_image_name, image),
-                                                          re.findall(DevOpsScript.regex_docker_tag, image)):
-                            parsed[image_name] = docker_tag[0]
-                    except:
-                        continue
-        return parsed
+        with ThreadPoolExecutor(max_workers=len(vars_yaml['vars']['folders']) or 1) as executor:
+            for result in [executor.submit(pull, git_folders, private_keys) for git_folders, private_keys
+                           in zip(vars_yaml['vars']['folders'], vars_yaml['vars']['keys'])]:
+                result.result()
 
     def output_manifests(self, type_instance):
+        # compose files one or two directories below the root, found in a single walk
         docker_compose_files = []
-        for all_yaml in self.depth:
-            for project_dir in glob.glob(os.path.join(type_instance, all_yaml)):
-                files = [f for ext in self.extensions for f in glob.glob(os.path.join(project_dir, ext))]
-                for list_compose_files in files:
-                    docker_compose_files.append(list_compose_files)
+        for root, dirs, files in os.walk(type_instance):
+            level = 0 if root == type_instance else os.path.relpath(root, type_instance).count(os.sep) + 1
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.')) if level < self.depth else []
+            if level > 0:
+                docker_compose_files.extend(os.path.join(root, f) for f in sorted(files)
+                                            if f.endswith(self.extensions) and not f.startswith('.'))
         return docker_compose_files
 
     def output_manifests_kubernetes(self, type_instance):
         kubernetes_files = []
-        for deployments in os.listdir('%s/services' % type_instance):
+        for deployments in sorted(os.listdir('%s/services' % type_instance)):
             kubernetes_files.append('%s/services/%s/deployment.yaml' % (type_instance, deployments))
         return kubernetes_files
 
+    def parse_manifests(self, jobs):
+        # unchanged files (same mtime and size) are served from the cache, the rest parsed in parallel
+        try:
+            with open(self.manifest_cache, 'r') as stream:
+                cache = json.load(stream)
+        except (OSError, ValueError):
+            cache = {}
+
+        results = {}
+        pending = []
+        removed = 0
+        for path, kind in jobs:
+            if not os.path.isfile(path):
+                removed += cache.pop(path, None) is not None
+                continue
+            stat = os.stat(path)
+            key = [stat.st_mtime_ns, stat.st_size, kind]
+            cached = cache.get(path)
+            if cached and cached['key'] == key:
+                results[path] = cached['images']
+            else:
+                pending.append((path, kind))
+                cache[path] = {'key': key}
+
+        if pending:
+            with ProcessPoolExecutor() as executor:
+                for path, parsed in executor.map(parse_manifest, pending, chunksize=16):
+                    results[path] = cache[path]['images'] = parsed
+
+        if pending or removed:
+            with open(self.manifest_cache + '.tmp', 'w') as stream:
+                json.dump(cache, stream)
+            os.replace(self.manifest_cache + '.tmp', self.manifest_cache)
+        return [results.get(path, {}) for path, kind in jobs]
+
+    @staticmethod
+    def is_k8s_manifest(relative_path):
+        parts = relative_path.split('/')
+        return len(parts) == 3 and parts[0] == 'services' and parts[2] == 'deployment.yaml'
+
+    def is_compose_manifest(self, relative_path):
+        parts = relative_path.split('/')
+        return (2 <= len(parts) <= self.depth + 1 and parts[-1].endswith(self.extensions)
+                and not any(part.startswith('.') for part in parts))
+
+    def discover_manifests(self, folder, kind, state):
+        # after the first full scan only files touched since the last processed commit are parsed again
+        listing, matches = ((self.output_manifests_kubernetes, self.is_k8s_manifest) if kind == 'k8s'
+                            else (self.output_manifests, self.is_compose_manifest))
+        repo = Repo(folder)
+        head = repo.head.commit.hexsha
+        key = '%s:%s' % (kind, folder)
+        last = state['commits'].get(key)
+        files = state['files'].setdefault(key, {})
+        changed = []
+        if last is None:
+            files.clear()
+            changed = listing(folder)
+        elif last != head:
+            try:
+                diff = repo.git.diff('--name-only', '--no-renames', last, head).splitlines()
+                changed = [os.path.join(folder, *name.split('/')) for name in diff if matches(name)]
+            except GitCommandError:
+                files.clear()
+                changed = listing(folder)
+
+        for path, images in zip(changed, self.parse_manifests([(path, kind) for path in changed])):
+            if os.path.isfile(path):
+                files[path] = images
+            else:
+                files.pop(path, None)
+        state['commits'][key] = head
+        return files
+
     def join_dict_to_dict(self):
+        with open('info.yaml', "r") as stream:
+            vars_yaml = yaml.load(stream, Loader=SafeLoader)
+        exclude_list = set(vars_yaml['vars']['exclude_list'] or [])
+        try:
+            with open(self.deploy_state, 'r') as stream:
+                state = json.load(stream)
+        except (OSError, ValueError):
+            state = {'commits': {}, 'files': {}}
+
+        k8s_files = self.discover_manifests(vars_yaml['vars']['folders'][0], 'k8s', state)
+        docker_files = self.discover_manifests(vars_yaml['vars']['folders'][1], 'compose', state)
+        with open(self.deploy_state + '.tmp', 'w') as stream:
+            json.dump(state, stream)
+        os.replace(self.deploy_state + '.tmp', self.deploy_state)
+
         k8s_dict = {}
-        vars_yaml = yaml.safe_load(open('info.yaml', "r"))
-        for kubernetes_manifests in self.output_manifests_kubernetes(vars_yaml['vars']['folders'][0]):
-            if kubernetes_manifests not in vars_yaml['vars']['exclude_list']:
-                for k8s_image, k8s_tag in self.k8s_yaml_parser(kubernetes_manifests).items():
-                    k8s_dict[k8s_image] = k8s_tag
+        for path in sorted(k8s_files):
+            if path not in exclude_list:
+                k8s_dict.update(k8s_files[path])
         docker_dict = {}
-        for docker_manifests in self.output_manifests(vars_yaml['vars']['folders'][1]):
-            if docker_manifests not in vars_yaml['vars']['exclude_list']:
-                try:
-                    for docker_image, docker_tag in DevOpsScript.docker_yaml_parser(docker_manifests).items():
-                        docker_dict[docker_image] = docker_tag
-                except KeyError:
-                    continue
+        for path in sorted(docker_files):
+            if path not in exclude_list:
+                docker_dict.update(docker_files[path])
         main_dict = k8s_dict | docker_dict
         return main_dict
 
-    @staticmethod
-    def get_tags(url, repo, headers):
+    def get_tags(self, url, repo, headers):
         params = {'orderby': 'timedesc'}
-        with requests.get('https://%s/v2/%s/tags/list' % (url, repo), headers=headers, params=params) as data:
+        answer = {'name': repo, 'tags': []}
+        for page in self.get_pages('https://%s/v2/%s/tags/list' % (url, repo), headers, params):
+            answer['name'] = page.get('name', repo)
+            answer['tags'].extend(page.get('tags') or [])
+        return answer
+
+    def get_repo_attributes(self, url, repo, headers):
+        with self.session.get('https://%s/acr/v1/%s' % (url, repo), headers=headers) as data:
             answer = json.loads(data.text)
         return answer
 
-    @staticmethod
-    def get_repos_with_tags(registry, auth, params):
-        repos = {}
-        with requests.get('https://%s/acr/v1/_catalog' % registry, headers=auth, params=params) as data:
+    def get_repos_with_tags(self, registry, auth, params):
+        catalog = []
+        for page in self.get_pages('https://%s/acr/v1/_catalog' % registry, auth, params):
+            catalog.extend(page.get('repositories') or [])
+        known = self.inventory.repo_updates()
+
+        def refresh(repo):
+            last_update = self.get_repo_attributes(registry, repo, auth).get('lastUpdateTime')
+            if last_update is not None and known.get(repo) == last_update:
+                return None
+            tags = self.get_tags(registry, repo, auth)['tags']
+            manifests = self.show_digests(registry, repo, auth)['manifests']
+            references = {manifest['digest']: self.get_manifest_references(registry, repo, manifest, auth)
+                          for manifest in manifests if manifest.get('mediaType') in MANIFEST_LIST_TYPES}
+            return repo, last_update, tags, manifests, references
+
+        # the database is written from this thread only, workers just fetch
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            changed = 0
+            for result in executor.map(refresh, catalog):
+                if result is not None:
+                    self.inventory.replace_repo(*result)
+                    changed += 1
+        self.inventory.remove_repos(set(known) - set(catalog))
+        print('Registry inventory: %d repositories, %d refreshed' % (len(catalog), changed))
+        return self.inventory.tags()
+
+    def get_manifest_references(self, url, repo_name, manifest, headers):
+        if manifest.get('references'):
+            return [reference['digest'] for reference in manifest['references']]
+        headers = dict(headers, Accept=', '.join(MANIFEST_LIST_TYPES))
+        with self.session.get('https://%s/v2/%s/manifests/%s' % (url, repo_name, manifest['digest']),
+                              headers=headers) as data:
             answer = json.loads(data.text)
-        for repo in answer['repositories']:
-            repo_data = DevOpsScript.get_tags(registry, repo, auth)  # Зміна тут
-            repos[repo_data['name']] = repo_data['tags']
-        return repos
+        return [child['digest'] for child in answer.get('manifests', [])]
 
     def show_digests(self, url, repo_name, headers):
-        with requests.get('https://%s/acr/v1/%s/_manifests' % (url, repo_name), headers=headers,
-                          params=self.params) as data:
-            answer = json.loads(data.text)
+        answer = {'manifests': []}
+        for page in self.get_pages('https://%s/acr/v1/%s/_manifests' % (url, repo_name), headers, self.params):
+            answer['manifests'].extend(page.get('manifests') or [])
         return answer
 
-    def remove_function(self, array_name, array_tag):
-        for deleted_versions in array_tag:
-            print('Will delete image: %s tag: %s' % (array_name, deleted_versions))
-            self.delete_tags(self.registry, array_name, deleted_versions, self.auth)
-        for digest in self.show_digests(self.registry, array_name, self.auth)['manifests']:
-            try:
-                print('Will stay image: %s with tag: %s' % (array_name, digest['tags']))
-            except:
-                print('Will delete untagged manifest: %s from image: %s' % (array_name, digest['digest']))
-                self.delete_manifests(self.registry, array_name, digest['digest'], self.auth)
+    def keep_rules(self):
+        # prod tags and everything newer, the newest KEEP_LAST tags and images pinned in info.yaml (e.g. stage)
+        keep_last = int(os.getenv('KEEP_LAST', 0))
+        with open('info.yaml', "r") as stream:
+            vars_yaml = yaml.load(stream, Loader=SafeLoader)
+        pinned = {}
+        for image in vars_yaml['vars'].get('keep') or []:
+            image_name, _, tag = image.rpartition(':')
+            pinned.setdefault(image_name, set()).add(tag)
+
+        keep_tags = {}
+        for prod_image, prod_version in self.prod_array.items():
+            tags = self.registry_array.get(prod_image)
+            if tags is None:
+                continue
+            position = {tag: index for index, tag in enumerate(tags)}
+            if prod_version not in position:
+                print('Deployed tag %s of image %s is not in the registry, keeping all tags' % (prod_version, prod_image))
+                continue
+            cutoff = max(position[prod_version] + 1, keep_last)
+            keep_tags[prod_image] = set(tags[:cutoff]) | pinned.get(prod_image, set())
+        return keep_tags
+
+    @staticmethod
+    def print_plan(plan):
+        for repo_name, repo_plan in sorted(plan.items()):
+            print('Will delete image: %s tags: %d manifests: %d (%.1f MB)' % (
+                repo_name, len(repo_plan['tags']), len(repo_plan['digests']), repo_plan['bytes'] / 1024 ** 2))
+        print('Total: %d images, %d tags, %d manifests, %.1f MB reclaimed' % (
+            len(plan), sum(len(repo_plan['tags']) for repo_plan in plan.values()),
+            sum(len(repo_plan['digests']) for repo_plan in plan.values()),
+            sum(repo_plan['bytes'] for repo_plan in plan.values()) / 1024 ** 2))
+
+    @staticmethod
+    def plan_operations(plan):
+        operations = []
+        for repo_name, repo_plan in plan.items():
+            operations.extend(('tag', repo_name, tag) for tag in repo_plan['tags'])
+            operations.extend(('manifest', repo_name, digest) for digest in repo_plan['digests'])
+        return operations
+
+    def save_plan(self, plan, keep_tags):
+        # the keep set the plan was built from is stored for reference, a resume checks against the current one
+        checkpoint = {'created': time.time(), 'prod': self.prod_array,
+                      'keep': {repo_name: sorted(tags) for repo_name, tags in keep_tags.items()}, 'plan': plan}
+        with open(self.checkpoint + '.tmp', 'w') as stream:
+            json.dump(checkpoint, stream)
+        os.replace(self.checkpoint + '.tmp', self.checkpoint)
+        if os.path.exists(self.checkpoint + '.done'):
+            os.remove(self.checkpoint + '.done')
+
+    def load_plan(self):
+        if not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint, 'r') as stream:
+            checkpoint = json.load(stream)
+        if 'created' not in checkpoint or time.time() - checkpoint['created'] > self.checkpoint_max_age:
+            print('Checkpoint %s is too old, planning again' % self.checkpoint)
+            return None
+        return checkpoint
+
+    def resume_plan(self, checkpoint, keep_tags):
+        # only operations the current keep rules would still plan are resumed, e.g. a rolled back prod tag stays
+        allowed = set(self.plan_operations(GCPlanner(self.inventory).plan(keep_tags)))
+        plan = {}
+        dropped = 0
+        for repo_name, repo_plan in checkpoint['plan'].items():
+            tags = [tag for tag in repo_plan['tags'] if ('tag', repo_name, tag) in allowed]
+            digests = [digest for digest in repo_plan['digests'] if ('manifest', repo_name, digest) in allowed]
+            dropped += len(repo_plan['tags']) - len(tags) + len(repo_plan['digests']) - len(digests)
+            sizes = {manifest['digest']: manifest['imageSize'] or 0 for manifest in self.inventory.manifests(repo_name)}
+            plan[repo_name] = {'tags': tags, 'digests': digests, 'bytes': sum(sizes.get(digest, 0) for digest in digests)}
+        if dropped:
+            print('Dropped %d operations of the checkpoint that touch tags kept now' % dropped)
+        return plan
+
+    def run_operation(self, operation):
+        kind, repo_name, reference = operation
+        self.limiter.wait()
+        if kind == 'tag':
+            status = self.delete_tags(self.registry, repo_name, reference, self.auth)
+        else:
+            status = self.delete_manifests(self.registry, repo_name, reference, self.auth)
+        # 404 means an earlier, interrupted run already removed it
+        if status in (200, 202, 204, 404):
+            return 'deleted'
+        # other client errors (e.g. a locked manifest) won't succeed on a retry either
+        if 400 <= status < 500 and status != 429:
+            print('Failed to delete %s %s from image %s permanently: %d' % (kind, reference, repo_name, status))
+            return 'failed-permanent'
+        return 'retry'
+
+    def run_plan(self, plan):
+        done = set()
+        done_path = self.checkpoint + '.done'
+        if os.path.exists(done_path):
+            with open(done_path, 'r') as stream:
+                done = {line.rstrip('\n').split(' ', 1)[1] for line in stream}
+        operations = [operation for operation in self.plan_operations(plan) if ' '.join(operation) not in done]
+        print('Deleting %d objects (%d already done)' % (len(operations), len(done)))
+
+        failed = 0
+        permanent = 0
+        with open(done_path, 'a') as log, ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.run_operation, operation): operation for operation in operations}
+            for future in as_completed(futures):
+                operation = futures[future]
+                try:
+                    result = future.result()
+                except requests.RequestException as e:
+                    print('Failed to delete %s %s from image %s: %s' % (operation[0], operation[2], operation[1], e))
+                    result = 'retry'
+                # permanent failures are logged as done too, so they don't pin the checkpoint
+                if result == 'retry':
+                    failed += 1
+                else:
+                    permanent += result == 'failed-permanent'
+                    log.write('%s %s\n' % (result, ' '.join(operation)))
+                    log.flush()
+
+        # deleted repositories are refetched on the next run
+        self.inventory.invalidate(list(plan))
+        if permanent:
+            print('%d deletions were refused by the registry and are not retried' % permanent)
+        if failed:
+            print('%d deletions failed, run again to retry them' % failed)
+        else:
+            os.remove(self.checkpoint)
+            os.remove(done_path)
+        return failed + permanent
 
     def delete_tags(self, url, repo_name, repo_tag, headers):
-        with requests.delete('https://%s/acr/v1/%s/_tags/%s' % (url, repo_name, repo_tag), headers=headers,
-                             params=self.params) as data:
+        with self.session.delete('https://%s/acr/v1/%s/_tags/%s' % (url, repo_name, repo_tag), headers=headers,
+                                 params=self.params) as data:
             answer = data.status_code
         return answer
 
     def delete_manifests(self, url, repo_name, digest, headers):
-        with requests.delete('https://%s/v2/%s/manifests/%s' % (url, repo_name, digest), headers=headers,
-                             params=self.params) as data:
+        with self.session.delete('https://%s/v2/%s/manifests/%s' % (url, repo_name, digest), headers=headers,
+                                 params=self.params) as data:
             answer = data.status_code
         return answer
 
 
 if __name__ == "__main__":
-    script = DevOpsScript()
-    script.pull_repo()
-    clear_array = {}
+    parser = argparse.ArgumentParser(description='Remove registry images older than the deployed versions')
+    parser.add_argument('--plan', action='store_true', help='Only print what would be deleted')
+    parser.add_argument('--offline', action='store_true', help='Plan from the local registry inventory without crawling')
+    parser.add_argument('--fresh', action='store_true', help='Ignore an unfinished checkpoint and plan again')
+    args = parser.parse_args()
+
+    # an interrupted run continues from a recent checkpoint without crawling the registry again, --plan always plans anew
+    script = DevOpsScript(crawl=False)
+    checkpoint = None if args.fresh or args.plan else script.load_plan()
+    if checkpoint is None:
+        script = DevOpsScript(offline=args.offline)
+        script.pull_repo()
+        # pick up what the pull brought in; only the changed manifests are parsed
+        script.prod_array = script.join_dict_to_dict()
 
-    for prod_image, prod_version in script.prod_array.items():
-        if prod_image in list(script.registry_array.keys()):
-            del script.registry_array[prod_image][0:script.registry_array[prod_image].index(prod_version) + 1]
-            clear_array[prod_image] = script.registry_array[prod_image]
+        keep_tags = script.keep_rules()
+        plan = GCPlanner(script.inventory).plan(keep_tags)
+        if not args.plan:
+            script.save_plan(plan, keep_tags)
+    else:
+        # deployed tags may have changed (e.g. a rollback) since the checkpoint was written
+        script.pull_repo()
+        script.registry_array = script.inventory.tags()
+        script.prod_array = script.join_dict_to_dict()
+        plan = script.resume_plan(checkpoint, script.keep_rules())
 
-    for name, tag in clear_array.items():
-        script.remove_function(name, tag)
+    script.print_plan(plan)
+    if not args.plan:
+        script.run_plan(plan)
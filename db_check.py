@@ -1,11 +1,13 @@
 #!/usr/bin/python3 env
 
-import prometheus_client, psycopg, os, requests
+import prometheus_client, os, requests, threading, time, asyncio, yaml
 from prometheus_client import Gauge, CollectorRegistry
 from flask import Response, Flask
 from dotenv import load_dotenv
 from pathlib import Path
 from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from token_manager import TokenManager
 
 # load app
 app = Flask(__name__)
@@ -19,12 +21,11 @@ name = os.getenv('DB_NAME')
 user = os.getenv('DB_USER')
 password = os.getenv('DB_PASSWORD')
 host = os.getenv('DB_HOST')
+sslmode = os.getenv('DB_SSLMODE', 'require')
+statement_timeout = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 5000))
+targets_file = os.getenv('DB_TARGETS', 'targets.yaml')
 
 
-headers = {'accept': 'text/plain'}
-verificationTokenUrl = 'https://domain.com/v3/signin/StartEmailLogin'
-refreshTokenUrl = 'https://domain.com/v3/signin/ConfirmEmailLogin'
-refreshTokenUrlNew = 'https://domain.com/v3/RefreshToken'
 email = os.getenv('SIMPLE_EMAIL')
 
 
@@ -39,25 +40,12 @@ def balance_history(token):
     return response
 
 
-def refresh_token(account):
-    verificationTokenData = {'email': account, 'application': 0, 'platform': 2}
-    verificationToken = requests.post(verificationTokenUrl, headers=headers, json=verificationTokenData).json()['data']['verificationToken']
-    refreshTokenData = {'email': account, 'code': '000000', 'verificationToken': verificationToken}
-    refreshToken = requests.post(refreshTokenUrl, headers=headers, json=refreshTokenData).json()['data']['refreshToken']
-    with open('file_token', 'w+') as write_token:
-        write_token.write(refreshToken)
-
-
-refresh_token(email)
+# access token is cached in memory and refreshed shortly before it expires, first login happens on first use
+tokens = TokenManager('https://domain.com/v3', email, token_file=os.getenv('TOKEN_FILE', 'file_token'))
 
 
 def generate_headers():
-    with open('file_token', 'r') as read_token:
-        tokens = requests.post(refreshTokenUrlNew, headers={'accept': 'text/plain'}, json={'refreshToken': read_token.read()}).json()['data']
-        with open('file_token', 'w+') as write_token:
-            write_token.write(tokens['refreshToken'])
-        data = {'accept': 'application/json', 'Authorization': tokens['token']}
-        return data
+    return tokens.headers()
 
 # queries
 request = "select * from int_report_view.check_connect_status"
@@ -65,49 +53,244 @@ info_max_connections = "select max_conn,used,res_for_super,max_conn-used-res_for
                         from (select count(*) used from pg_stat_activity) t1, (select setting::int res_for_super \
                         from pg_settings where name=$$superuser_reserved_connections$$) t2, \
                         (select setting::int max_conn from pg_settings where name=$$max_connections$$) t3;"
+top_statements = int(os.getenv('PG_TOP_STATEMENTS', 10))
+server_stats = {
+    'connections': "select coalesce(state, 'unknown') state, coalesce(nullif(application_name, ''), 'unknown') \
+                    application_name, count(*) count from pg_stat_activity group by 1, 2",
+    'longest_transaction': "select coalesce(max(extract(epoch from now() - xact_start)), 0) seconds \
+                            from pg_stat_activity where xact_start is not null",
+    'replication_lag': "select application_name replica, coalesce(extract(epoch from replay_lag), 0) seconds \
+                        from pg_stat_replication union all select 'self', \
+                        coalesce(extract(epoch from now() - pg_last_xact_replay_timestamp()), 0) \
+                        where pg_is_in_recovery()",
+    'database_sizes': "select datname, pg_database_size(datname) size from pg_database where datallowconn",
+    'lock_waits': "select count(*) count from pg_stat_activity where wait_event_type = 'Lock'",
+    'max_connections': info_max_connections,
+    # the view only returns rows when the library is preloaded, total_exec_time needs PG13+
+    'pg_stat_statements': "select n.nspname schema, 'pg_stat_statements' = any(string_to_array(replace( \
+                           current_setting('shared_preload_libraries'), ' ', ''), ',')) \
+                           and current_setting('server_version_num')::int >= 130000 loaded \
+                           from pg_extension e join pg_namespace n on n.oid = e.extnamespace \
+                           where e.extname = 'pg_stat_statements'",
+}
+top_statements_query = "select queryid::text queryid, left(regexp_replace(query, '\\s+', ' ', 'g'), 80) query, calls, \
+                        total_exec_time from \"{schema}\".pg_stat_statements order by total_exec_time desc limit {limit}"
 
 # prometheus counter
-COUNTER_DB = Gauge('microservice_check_db', 'Base Gauge', ['microservice', 'type'], registry=CollectorRegistry())
+COUNTER_DB = Gauge('microservice_check_db', 'Base Gauge', ['instance', 'microservice', 'type'], registry=CollectorRegistry())
 COUNTER_CONNECTIONS = Gauge('check_max_connections', 'Base Gauge',
-                            ['type'], registry=CollectorRegistry())
+                            ['instance', 'type'], registry=CollectorRegistry())
+
+PG_REGISTRY = CollectorRegistry()
+PG_CONNECTIONS = Gauge('pg_connections', 'Backends per state and application', ['instance', 'state', 'application_name'],
+                       registry=PG_REGISTRY)
+PG_LONGEST_TRANSACTION = Gauge('pg_longest_transaction_seconds', 'Age of the oldest open transaction',
+                               ['instance'], registry=PG_REGISTRY)
+PG_REPLICATION_LAG = Gauge('pg_replication_lag_seconds', 'Replay lag per standby, self when in recovery',
+                           ['instance', 'replica'], registry=PG_REGISTRY)
+PG_DATABASE_SIZE = Gauge('pg_database_size_bytes', 'Database size', ['instance', 'database'], registry=PG_REGISTRY)
+PG_LOCK_WAITS = Gauge('pg_lock_waits', 'Backends waiting on a lock', ['instance'], registry=PG_REGISTRY)
+PG_STATEMENT_CALLS = Gauge('pg_statement_calls', 'Calls of the top statements by total time',
+                           ['instance', 'queryid', 'query'], registry=PG_REGISTRY)
+PG_STATEMENT_TIME = Gauge('pg_statement_total_exec_time_ms', 'Total execution time of the top statements',
+                          ['instance', 'queryid', 'query'], registry=PG_REGISTRY)
+PG_UP = Gauge('pg_up', 'Whether the last collection from the instance succeeded', ['instance', 'check'],
+              registry=PG_REGISTRY)
+
+# collector health, served next to every snapshot
+STATUS_REGISTRY = CollectorRegistry()
+LAST_SUCCESS = Gauge('db_check_last_success_timestamp', 'Unix time of the last successful collection',
+                     ['check'], registry=STATUS_REGISTRY)
+COLLECTION_DURATION = Gauge('db_check_collection_duration_seconds', 'Duration of the last collection',
+                            ['check'], registry=STATUS_REGISTRY)
+
+
+def load_targets():
+    # one entry per Postgres server; without a targets file the DB_* environment describes a single one
+    if not os.path.exists(targets_file):
+        return [{'instance': host, 'host': host, 'check_connect_status': True}]
+    with open(targets_file, 'r') as stream:
+        return yaml.safe_load(stream)['targets']
+
+
+targets = load_targets()
+
+# one small pool per target, every query is bounded by statement_timeout; connections are not checked on checkout
+# to keep a collection at one round trip, broken ones are dropped on return and the rest are recycled by age
+pools = {
+    target['instance']: AsyncConnectionPool(
+        kwargs={'dbname': target.get('dbname', name), 'user': target.get('user', user),
+                'password': os.getenv(target['password_env']) if 'password_env' in target else target.get('password', password),
+                'host': target['host'], 'port': target.get('port', 5432), 'sslmode': target.get('sslmode', sslmode),
+                'options': f"-c statement_timeout={target.get('statement_timeout', statement_timeout)}",
+                'autocommit': True},
+        min_size=int(os.getenv('DB_POOL_MIN', 1)),
+        max_size=int(os.getenv('DB_POOL_MAX', 4)),
+        max_idle=300,
+        max_lifetime=int(os.getenv('DB_POOL_MAX_LIFETIME', 1800)),
+        open=False,
+    )
+    for target in targets
+}
+
 
+async def fan_out(check, query_target, selected):
+    # query every target concurrently, each bounded by its own timeout; a slow host only costs its own series
+    results = await asyncio.gather(*[asyncio.wait_for(query_target(target), target.get('timeout', 10))
+                                     for target in selected], return_exceptions=True)
+    succeeded = {}
+    for target, result in zip(selected, results):
+        if isinstance(result, BaseException):
+            print(f"{check} on {target['instance']} failed: {result!r}")
+            PG_UP.labels(instance=target['instance'], check=check).set(0)
+        else:
+            succeeded[target['instance']] = result
+            PG_UP.labels(instance=target['instance'], check=check).set(1)
+    return succeeded
 
-connect = psycopg.connect(dbname=name, user=user, password=password, host=host, sslmode='require')
-def check_db(check_db_status):
+
+async def query_check_db(target):
+    async with pools[target['instance']].connection() as connect:
+        async with connect.cursor(row_factory=dict_row) as current:
+            await current.execute(request)
+            return await current.fetchall()
+
+
+async def check_db():
+    results = await fan_out('check_db', query_check_db,
+                            [target for target in targets if target.get('check_connect_status')])
     COUNTER_DB.clear()
-    connect = psycopg.connect(dbname=name, user=user, password=password, host=host)
-    with connect.cursor(row_factory=dict_row) as current:
-        current.execute(check_db_status)
-        for record in current:
-            COUNTER_DB.labels(microservice=record['app_name'], type=record['type']).set(int(1))
-        current.close()
-
-
-def check_max_connections(max_connections):
-    COUNTER_CONNECTIONS.clear()
-    connect = psycopg.connect(dbname=name, user=user, password=password, host=host)
-    with connect.cursor(row_factory=dict_row) as current:
-        current.execute(max_connections)
-        for record in current:
-            counter_records = {'max_conn': record['max_conn'], 'used': record['used'], 'free_for_superusers': record['res_for_super'], 'free_for_users': record['res_for_normal']}
-            for key, value in counter_records.items():
-                COUNTER_CONNECTIONS.labels(type=key).inc(value)
-        current.close()
+    for instance, records in results.items():
+        for record in records:
+            COUNTER_DB.labels(instance=instance, microservice=record['app_name'], type=record['type']).set(int(1))
+
+
+def set_max_connections(instance, records):
+    for record in records:
+        counter_records = {'max_conn': record['max_conn'], 'used': record['used'], 'free_for_superusers': record['res_for_super'], 'free_for_users': record['res_for_normal']}
+        for key, value in counter_records.items():
+            COUNTER_CONNECTIONS.labels(instance=instance, type=key).set(value)
+
+
+# schema of pg_stat_statements on targets where it is installed and loaded
+pg_stat_statements_available = {}
+
+
+async def query_server_stats(target):
+    # every query goes out in one pipeline, results are read after the single sync
+    queries = dict(server_stats)
+    schema = pg_stat_statements_available.get(target['instance'])
+    if schema:
+        queries['top_statements'] = top_statements_query.format(schema=schema.replace('"', '""'), limit=top_statements)
+    try:
+        async with pools[target['instance']].connection() as connect:
+            cursors = {key: connect.cursor(row_factory=dict_row) for key in queries}
+            async with connect.pipeline():
+                for key, query in queries.items():
+                    await cursors[key].execute(query)
+            results = {key: await cursor.fetchall() for key, cursor in cursors.items()}
+    except BaseException:
+        # a failing top-N query aborts the whole batch, so the next collection runs without it and detects again
+        pg_stat_statements_available[target['instance']] = None
+        raise
+    extension = results['pg_stat_statements']
+    pg_stat_statements_available[target['instance']] = extension[0]['schema'] if extension and extension[0]['loaded'] else None
+    return results
+
+
+async def check_server_stats():
+    results = await fan_out('server_stats', query_server_stats, targets)
+    for gauge in (COUNTER_CONNECTIONS, PG_CONNECTIONS, PG_LONGEST_TRANSACTION, PG_REPLICATION_LAG,
+                  PG_DATABASE_SIZE, PG_LOCK_WAITS, PG_STATEMENT_CALLS, PG_STATEMENT_TIME):
+        gauge.clear()
+    for instance, result in results.items():
+        for record in result['connections']:
+            PG_CONNECTIONS.labels(instance=instance, state=record['state'],
+                                  application_name=record['application_name']).set(record['count'])
+        PG_LONGEST_TRANSACTION.labels(instance=instance).set(result['longest_transaction'][0]['seconds'])
+        for record in result['replication_lag']:
+            PG_REPLICATION_LAG.labels(instance=instance, replica=record['replica']).set(record['seconds'])
+        for record in result['database_sizes']:
+            PG_DATABASE_SIZE.labels(instance=instance, database=record['datname']).set(record['size'])
+        PG_LOCK_WAITS.labels(instance=instance).set(result['lock_waits'][0]['count'])
+        for record in result.get('top_statements', []):
+            PG_STATEMENT_CALLS.labels(instance=instance, queryid=record['queryid'], query=record['query']).set(record['calls'])
+            PG_STATEMENT_TIME.labels(instance=instance, queryid=record['queryid'], query=record['query']).set(record['total_exec_time'])
+        set_max_connections(instance, result['max_connections'])
+
+
+async def collect_db():
+    token_data = await asyncio.to_thread(generate_headers)
+    response = await asyncio.to_thread(balance_history, token_data)
+    if response.status_code == 401:
+        # revoked before its expiry, the next collection fetches a new one
+        tokens.invalidate()
+    await check_db()
+    return {'check_db': prometheus_client.generate_latest(COUNTER_DB)}
+
+
+async def collect_server_stats():
+    await check_server_stats()
+    return {'check_max_connections': prometheus_client.generate_latest(COUNTER_CONNECTIONS),
+            'pg_stats': prometheus_client.generate_latest(PG_REGISTRY)}
+
+
+# rendered output of the last successful collection per check
+snapshots = {}
+
+
+async def run_collector(check, collect, interval):
+    while True:
+        start = time.monotonic()
+        try:
+            snapshots.update(await collect())
+            LAST_SUCCESS.labels(check=check).set(time.time())
+        except Exception as e:
+            print(f'{check} collection failed: {e}')
+        elapsed = time.monotonic() - start
+        COLLECTION_DURATION.labels(check=check).set(elapsed)
+        await asyncio.sleep(max(0, interval - elapsed))
+
+
+collectors = {
+    'check_db': (collect_db, int(os.getenv('CHECK_DB_INTERVAL', 30))),
+    'server_stats': (collect_server_stats, int(os.getenv('CHECK_MAX_CONNECTIONS_INTERVAL', 15))),
+}
+
+
+async def run_collectors():
+    for pool in pools.values():
+        await pool.open(wait=False)
+    await asyncio.gather(*[run_collector(check_name, collect, interval)
+                           for check_name, (collect, interval) in collectors.items()])
+
+
+def start_collectors():
+    threading.Thread(target=asyncio.run, args=(run_collectors(),), daemon=True).start()
+
+
+def serve_snapshot(check):
+    return Response(snapshots.get(check, b'') + prometheus_client.generate_latest(STATUS_REGISTRY),
+                    mimetype="text/plain")
 
 
 @app.route("/check_db")
 def db_check():
-    token_data = generate_headers()
-    balance_history(token_data)
-    check_db(request)
-    return Response(prometheus_client.generate_latest(COUNTER_DB), mimetype="text/plain")
+    return serve_snapshot('check_db')
 
 
 @app.route("/check_max_connections")
 def db_check_connections():
-    check_max_connections(info_max_connections)
-    return Response(prometheus_client.generate_latest(COUNTER_CONNECTIONS), mimetype="text/plain")
+    return serve_snapshot('check_max_connections')
+
+
+@app.route("/pg_stats")
+def db_server_stats():
+    return serve_snapshot('pg_stats')
 
 
 if __name__ == "__main__":
+    # the reloader parent only watches files, collectors and pools live in the serving child
+    if os.getenv('WERKZEUG_RUN_MAIN') == 'true':
+        start_collectors()
     app.run(host="0.0.0.0", port=5454, debug=True)
@@ -0,0 +1,108 @@
+import itertools
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class CloudFlareAPIError(Exception):
+    pass
+
+
+class FakeZone:
+    # in-memory stand-in for the parts of the Cloudflare API the scripts use
+    def __init__(self, zone_id):
+        self.id = zone_id
+        self.records = {}
+        self.ids = itertools.count(1)
+
+    def add(self, data):
+        record = {'id': f'{self.id}-{next(self.ids)}', 'proxied': False, 'ttl': 1}
+        record.update({k: v for k, v in data.items() if k != 'id'})
+        self.records[record['id']] = record
+        return record
+
+
+class FakeAPI:
+    def __init__(self):
+        self.zones = {}
+        self.names = {}
+
+    def create_zone(self, zone_name, zone_id):
+        self.zones[zone_id] = FakeZone(zone_id)
+        self.names[zone_name] = zone_id
+        return self.zones[zone_id]
+
+    def zone(self, zone_id):
+        if zone_id not in self.zones:
+            raise CloudFlareAPIError(f'zone {zone_id} not found')
+        return self.zones[zone_id]
+
+
+class FakeEndpoint:
+    def __init__(self, **methods):
+        for name, method in methods.items():
+            setattr(self, name, method)
+
+
+class FakeClient:
+    def __init__(self, api, raw):
+        def list_zones(params):
+            zone_id = api.names.get(params['name'])
+            return [] if zone_id is None else [{'id': zone_id, 'name': params['name']}]
+
+        def list_records(zone_id, params):
+            records = sorted(api.zone(zone_id).records.values(), key=lambda record: record['id'])
+            per_page, page = params['per_page'], params['page']
+            result = [dict(record) for record in records[(page - 1) * per_page:page * per_page]]
+            if not raw:
+                return result
+            return {'result': result, 'result_info': {'total_pages': max(1, -(-len(records) // per_page))}}
+
+        def export(zone_id):
+            lines = [';; exported at a different time on every call']
+            for record in sorted(api.zone(zone_id).records.values(), key=lambda record: record['id']):
+                lines.append(f'{record["name"]}.\t{record["ttl"]}\tIN\t{record["type"]}\t{record["content"]}')
+            return '\n'.join(lines) + '\n'
+
+        def import_zone(zone_id, files):
+            zone = api.zone(zone_id)
+            parsed = 0
+            for line in files['file'][1].decode().splitlines():
+                if not line.strip() or line.startswith(';'):
+                    continue
+                name, ttl, _, record_type, content = line.split('\t')
+                zone.add({'name': name.rstrip('.'), 'ttl': int(ttl), 'type': record_type, 'content': content})
+                parsed += 1
+            return {'recs_added': parsed, 'total_records_parsed': parsed}
+
+        def create(zone_id, data):
+            return api.zone(zone_id).add(data)
+
+        def update(zone_id, record_id, data):
+            api.zone(zone_id).records[record_id] = dict(data, id=record_id)
+
+        def delete(zone_id, record_id):
+            del api.zone(zone_id).records[record_id]
+
+        dns_records = FakeEndpoint(get=list_records, post=create, put=update, delete=delete,
+                                   export=FakeEndpoint(get=export), import_=FakeEndpoint(post=import_zone))
+        self.zones = FakeEndpoint(get=list_zones, dns_records=dns_records)
+
+
+@pytest.fixture
+def cloudflare(monkeypatch, tmp_path):
+    api = FakeAPI()
+    fake_module = types.ModuleType('CloudFlare')
+    fake_module.CloudFlare = lambda token, raw=False: FakeClient(api, raw)
+    fake_module.exceptions = types.SimpleNamespace(CloudFlareAPIError=CloudFlareAPIError)
+    monkeypatch.setitem(sys.modules, 'CloudFlare', fake_module)
+    monkeypatch.delitem(sys.modules, 'backup_cloudflare', raising=False)
+    monkeypatch.chdir(tmp_path)
+    import backup_cloudflare
+    monkeypatch.setattr(backup_cloudflare, 'CF_REQUESTS_PER_SECOND', 1000)
+    api.module = backup_cloudflare
+    return api
@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+DOMAIN = 'example'
+ZONE = 'example.com'
+RECORDS = [
+    {'name': 'example.com', 'type': 'A', 'content': '192.0.2.1', 'ttl': 300},
+    {'name': 'www.example.com', 'type': 'CNAME', 'content': 'example.com', 'ttl': 300},
+    {'name': 'example.com', 'type': 'MX', 'content': 'mail.example.com', 'ttl': 3600},
+    {'name': 'example.com', 'type': 'TXT', 'content': 'v=spf1 -all', 'ttl': 3600},
+]
+
+
+def records_of(zone):
+    return sorted((record['name'], record['type'], record['content'], record['ttl']) for record in zone.records.values())
+
+
+@pytest.fixture
+def zone(cloudflare):
+    with open('config.yml', 'w') as config_file:
+        config_file.write(f'- name: {DOMAIN}\n  api_key: token\n  zone_name: {ZONE}\n')
+    zone = cloudflare.create_zone(ZONE, 'zone-1')
+    for record in RECORDS:
+        zone.add(record)
+    return zone
+
+
+def latest_snapshot(bc):
+    backup_folder = os.path.join('backups', DOMAIN)
+    snapshot = bc.load_index(backup_folder)['snapshots'][-1]
+    return bc.object_path(backup_folder, snapshot['hash'], snapshot['format'])
+
+
+def test_bind_round_trip(cloudflare, zone):
+    bc = cloudflare.module
+    expected = records_of(zone)
+
+    assert bc.backup_dns_records(DOMAIN, DOMAIN, 'bind') == len(RECORDS)
+    zone.records.clear()
+    bc.restore_dns_records(DOMAIN, DOMAIN, latest_snapshot(bc), fmt='bind')
+
+    assert records_of(zone) == expected
+
+
+def test_bind_backup_deduplicates_unchanged_zone(cloudflare, zone):
+    bc = cloudflare.module
+
+    bc.backup_dns_records(DOMAIN, DOMAIN, 'bind')
+    bc.backup_dns_records(DOMAIN, DOMAIN, 'bind')
+
+    index = bc.load_index(os.path.join('backups', DOMAIN))
+    assert len(index['snapshots']) == 2
+    assert list(index['refs'].values()) == [2]
+
+
+def test_bind_restore_refuses_non_empty_zone(cloudflare, zone):
+    bc = cloudflare.module
+    bc.backup_dns_records(DOMAIN, DOMAIN, 'bind')
+    zone.add({'name': 'new.example.com', 'type': 'A', 'content': '192.0.2.9', 'ttl': 300})
+    expected = records_of(zone)
+
+    with pytest.raises(SystemExit):
+        bc.restore_dns_records(DOMAIN, DOMAIN, latest_snapshot(bc), fmt='bind')
+
+    assert records_of(zone) == expected
+
+
+def test_json_round_trip_reverts_changes(cloudflare, zone):
+    bc = cloudflare.module
+    expected = records_of(zone)
+
+    bc.backup_dns_records(DOMAIN, DOMAIN)
+    first_id = sorted(zone.records)[0]
+    zone.records[first_id]['content'] = '192.0.2.2'
+    del zone.records[sorted(zone.records)[-1]]
+    zone.add({'name': 'new.example.com', 'type': 'A', 'content': '192.0.2.9', 'ttl': 300})
+    bc.restore_dns_records(DOMAIN, DOMAIN, latest_snapshot(bc))
+
+    assert records_of(zone) == expected
+    assert first_id in zone.records
+
+
+def test_stale_cached_zone_id_is_resolved_again(cloudflare, zone):
+    bc = cloudflare.module
+    bc.cache_zone_id(ZONE, 'zone-gone')
+
+    assert bc.backup_dns_records(DOMAIN, DOMAIN) == len(RECORDS)
+    assert bc.get_cached_zone_id(ZONE) == 'zone-1'
+
+
+def test_mx_priority_change_is_diffed_and_restored(cloudflare, zone):
+    bc = cloudflare.module
+    mx = next(record for record in zone.records.values() if record['type'] == 'MX')
+    mx['priority'] = 10
+
+    bc.backup_dns_records(DOMAIN, DOMAIN)
+    mx['priority'] = 20
+    diff = bc.diff_zone(DOMAIN, DOMAIN)
+    bc.restore_dns_records(DOMAIN, DOMAIN, latest_snapshot(bc))
+
+    assert [change['backup']['priority'] for change in diff['changed']] == [10]
+    assert zone.records[mx['id']]['priority'] == 10
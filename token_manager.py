@@ -0,0 +1,97 @@
+#!/usr/bin/python3 env
+
+import base64, json, os, tempfile, threading, time
+import requests
+
+
+def token_expiry(token, default_ttl):
+    # access tokens are JWTs, fall back to a fixed lifetime when the exp claim can not be read
+    try:
+        payload = token.split('.')[1]
+        return float(json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + default_ttl
+
+
+def write_atomic(path, data):
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class TokenManager:
+    def __init__(self, base_url, account, token_file, skew=None, default_ttl=None):
+        self.verification_url = '%s/signin/StartEmailLogin' % base_url
+        self.confirm_url = '%s/signin/ConfirmEmailLogin' % base_url
+        self.refresh_url = '%s/RefreshToken' % base_url
+        self.account = account
+        self.token_file = token_file
+        self.skew = skew if skew is not None else int(os.getenv('TOKEN_REFRESH_SKEW', 60))
+        self.default_ttl = default_ttl if default_ttl is not None else int(os.getenv('TOKEN_DEFAULT_TTL', 300))
+        self.session = requests.Session()
+        self.session.headers.update({'accept': 'text/plain'})
+        self.lock = threading.Lock()
+        self.access_token = None
+        self.expires_at = 0
+        self.refresh_token = None
+
+    def valid(self):
+        return self.access_token is not None and time.time() < self.expires_at - self.skew
+
+    def headers(self):
+        # steady state is a memory read, only one caller refreshes while the others wait for its result
+        if not self.valid():
+            with self.lock:
+                if not self.valid():
+                    self.refresh()
+        return {'accept': 'application/json', 'Authorization': self.access_token}
+
+    def invalidate(self):
+        with self.lock:
+            self.access_token = None
+
+    def stored_refresh_token(self):
+        if self.refresh_token is None and os.path.exists(self.token_file):
+            with open(self.token_file, 'r') as read_token:
+                self.refresh_token = read_token.read().strip() or None
+        return self.refresh_token
+
+    def store_refresh_token(self, refresh_token):
+        if refresh_token != self.refresh_token:
+            write_atomic(self.token_file, refresh_token)
+            self.refresh_token = refresh_token
+
+    def login(self):
+        verificationTokenData = {'email': self.account, 'application': 0, 'platform': 2}
+        response = self.session.post(self.verification_url, json=verificationTokenData, timeout=10)
+        response.raise_for_status()
+        verificationToken = response.json()['data']['verificationToken']
+        refreshTokenData = {'email': self.account, 'code': '000000', 'verificationToken': verificationToken}
+        response = self.session.post(self.confirm_url, json=refreshTokenData, timeout=10)
+        response.raise_for_status()
+        self.store_refresh_token(response.json()['data']['refreshToken'])
+
+    def exchange(self):
+        response = self.session.post(self.refresh_url, json={'refreshToken': self.refresh_token}, timeout=10)
+        response.raise_for_status()
+        return response.json()['data']
+
+    def refresh(self):
+        if self.stored_refresh_token() is None:
+            self.login()
+        try:
+            tokens = self.exchange()
+        except (requests.RequestException, KeyError, TypeError, ValueError) as e:
+            # the stored refresh token was revoked or already used, start over with a new login
+            print(f'Token refresh failed, logging in again: {e}')
+            self.login()
+            tokens = self.exchange()
+        self.store_refresh_token(tokens['refreshToken'])
+        self.access_token = tokens['token']
+        self.expires_at = token_expiry(self.access_token, self.default_ttl)
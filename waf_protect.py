@@ -1,12 +1,18 @@
 #!/usr/local/bin/python3.11 env
 
+import argparse
+import ipaddress
 import requests
 import json
 import os
+import sqlite3
 import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, NotFoundError
 
 
 class ElasticSearchClient:
@@ -16,61 +22,297 @@ class ElasticSearchClient:
     def search(self, index, body):
         return self.client.search(index=index, body=body, ignore=404)
 
+    def scan(self, index, body, fields, page_size=5000, keep_alive='1m'):
+        # page through every hit of the query with a point in time and search_after
+        try:
+            pit_id = self.client.open_point_in_time(index=index, keep_alive=keep_alive, ignore_unavailable=True)['id']
+        except NotFoundError:
+            return
+        body = dict(body, size=page_size, fields=fields, _source=False,
+                    sort=[{'@timestamp': 'asc'}, {'_shard_doc': 'asc'}])
+        try:
+            while True:
+                body['pit'] = {'id': pit_id, 'keep_alive': keep_alive}
+                result = self.client.search(body=body)
+                pit_id = result.get('pit_id', pit_id)
+                hits = result['hits']['hits']
+                yield from hits
+                if len(hits) < page_size:
+                    break
+                body['search_after'] = hits[-1]['sort']
+        finally:
+            self.client.close_point_in_time(id=pit_id)
+
+    def aggregate(self, index, query, field, sub_fields, min_doc_count, page_size=1000):
+        # count per field value inside Elasticsearch and page through the composite buckets;
+        # composite aggregations have no min_doc_count, so small buckets are dropped here
+        aggs = {name: {'terms': {'field': sub_field, 'size': 1}} for name, sub_field in sub_fields.items()}
+        composite = {'size': page_size, 'sources': [{'key': {'terms': {'field': field}}}]}
+        body = {'size': 0, 'query': query, 'aggs': {'by_key': {'composite': composite, 'aggs': aggs}}}
+        while True:
+            result = self.client.search(index=index, body=body, ignore_unavailable=True)
+            by_key = result.get('aggregations', {}).get('by_key', {})
+            for bucket in by_key.get('buckets', []):
+                if bucket['doc_count'] >= min_doc_count:
+                    yield bucket
+            if 'after_key' not in by_key:
+                break
+            composite['after'] = by_key['after_key']
+
+
+class CloudflareError(Exception):
+    pass
+
 
 class CloudflareAPI:
-    def __init__(self, token):
+    # IP List limits on how wide a single entry may be; IPv6 entries can't be narrower than a /64
+    min_prefix = {4: 8, 6: 12}
+    max_prefix = {4: 32, 6: 64}
+
+    def __init__(self, token, account_id=None, list_id=None, list_name=None):
         self.token = token
         self.base_url = "https://api.cloudflare.com/client/v4"
+        self.account_id = account_id
+        self.list_id = list_id
+        self.list_name = list_name
+        # the IP List is only used when it is fully configured, otherwise the rule would point at $None
+        list_settings = {'CF_ACCOUNT_ID': account_id, 'CF_LIST_ID': list_id, 'CF_LIST_NAME': list_name}
+        missing = [name for name, value in list_settings.items() if not value]
+        if len(missing) not in (0, len(list_settings)):
+            raise ValueError(f"IP List mode needs CF_ACCOUNT_ID, CF_LIST_ID and CF_LIST_NAME, missing: {', '.join(missing)}")
+        self.use_list = not missing
+        self.rule_points_to_list = False
 
-    def block_ip_addresses(self, zone_id, ruleset_id, rule_id, ip_addresses):
-        url = f"{self.base_url}/zones/{zone_id}/rulesets/{ruleset_id}/rules/{rule_id}"
-        headers = {
+    @property
+    def headers(self):
+        return {
             "Authorization": f"Bearer {self.token}",
             "Content-Type": "application/json"
         }
+
+    def block_ip_addresses(self, zone_id, ruleset_id, rule_id, ip_addresses):
+        if self.use_list:
+            self.sync_ip_list(ip_addresses)
+            if not self.rule_points_to_list:
+                self.update_rule(zone_id, ruleset_id, rule_id, f"ip.src in ${self.list_name}")
+                self.rule_points_to_list = True
+            return
         expression = " or ".join([f"(ip.src eq {ip})" for ip in ip_addresses])
+        self.update_rule(zone_id, ruleset_id, rule_id, expression)
+
+    def update_rule(self, zone_id, ruleset_id, rule_id, expression):
+        url = f"{self.base_url}/zones/{zone_id}/rulesets/{ruleset_id}/rules/{rule_id}"
         data = {
             "action": "block",
             "expression": expression,
             "description": "BLOCK"
         }
-        response = requests.patch(url, headers=headers, json=data)
-        if response.status_code == 200:
-            print("WAF rules updated")
-        else:
-            print(f"Error code: {response.status_code}")
-            print(response.json())
+        response = requests.patch(url, headers=self.headers, json=data)
+        if response.status_code != 200:
+            raise CloudflareError(f"WAF rule update failed with code {response.status_code}: {response.text}")
+        print("WAF rules updated")
+
+    @classmethod
+    def coalesce(cls, ip_addresses):
+        # merge adjacent addresses into the smallest set of CIDRs covering the same addresses,
+        # IPv6 hosts are widened to their /64 first since that is the narrowest entry the list stores
+        networks = {4: [], 6: []}
+        for ip in ip_addresses:
+            try:
+                network = ipaddress.ip_network(ip, strict=False)
+            except ValueError:
+                print(f"Skipping invalid address: {ip}")
+                continue
+            if network.prefixlen > cls.max_prefix[network.version]:
+                network = network.supernet(new_prefix=cls.max_prefix[network.version])
+            networks[network.version].append(network)
+        result = set()
+        for version, version_networks in networks.items():
+            for network in ipaddress.collapse_addresses(version_networks):
+                if network.prefixlen < cls.min_prefix[version]:
+                    result.update(network.subnets(new_prefix=cls.min_prefix[version]))
+                else:
+                    result.add(network)
+        return result
+
+    def list_items(self):
+        url = f"{self.base_url}/accounts/{self.account_id}/rules/lists/{self.list_id}/items"
+        items = {}
+        params = {}
+        while True:
+            response = requests.get(url, headers=self.headers, params=params).json()
+            for item in response['result']:
+                items[ipaddress.ip_network(item['ip'], strict=False)] = item['id']
+            cursor = response.get('result_info', {}).get('cursors', {}).get('after')
+            if not cursor:
+                return items
+            params = {'cursor': cursor}
+
+    def wait_for_operation(self, response):
+        if response.status_code != 200 or not (response.json().get('result') or {}).get('operation_id'):
+            raise CloudflareError(f"IP List update failed with code {response.status_code}: {response.text}")
+        operation_id = response.json()['result']['operation_id']
+        url = f"{self.base_url}/accounts/{self.account_id}/rules/lists/bulk_operations/{operation_id}"
+        while True:
+            status = requests.get(url, headers=self.headers).json()['result']
+            if status['status'] == 'failed':
+                raise CloudflareError(f"IP List operation failed: {status.get('error')}")
+            if status['status'] == 'completed':
+                return
+            time.sleep(1)
+
+    def sync_ip_list(self, ip_addresses):
+        # only the difference between the wanted CIDRs and the list contents is sent
+        wanted = self.coalesce(ip_addresses)
+        current = self.list_items()
+        to_add = [network for network in wanted if network not in current]
+        to_remove = [item_id for network, item_id in current.items() if network not in wanted]
+
+        url = f"{self.base_url}/accounts/{self.account_id}/rules/lists/{self.list_id}/items"
+        if to_add:
+            items = [{"ip": str(network.network_address) if network.version == 4 and network.num_addresses == 1
+                      else str(network)} for network in to_add]
+            self.wait_for_operation(requests.post(url, headers=self.headers, json=items))
+        if to_remove:
+            items = {"items": [{"id": item_id} for item_id in to_remove]}
+            self.wait_for_operation(requests.delete(url, headers=self.headers, json=items))
+        print(f"IP List updated: {len(to_add)} added, {len(to_remove)} removed, {len(wanted)} entries")
+
+
+class BlocklistStore:
+    # blocked addresses keyed by their 16-byte packed form (IPv4 mapped into IPv6), so the
+    # primary key index serves both membership checks and CIDR range queries
+    def __init__(self, path, ttl_days=30):
+        self.db = sqlite3.connect(path)
+        self.ttl = ttl_days * 86400
+        self.db.executescript('''
+            create table if not exists blocked (address blob primary key, ip text, first_seen real, last_seen real,
+                                                hits integer, client_id text, expires real);
+            create index if not exists blocked_expires on blocked (expires);
+            create table if not exists events (time real, ip text, hits integer, client_id text);
+            create index if not exists events_time on events (time);
+        ''')
+
+    @staticmethod
+    def pack(ip):
+        address = ipaddress.ip_address(ip)
+        if address.version == 4:
+            address = ipaddress.IPv6Address(b'\0' * 10 + b'\xff\xff' + address.packed)
+        return address.packed
+
+    def block(self, blocked, clients):
+        now = time.time()
+        with self.db:
+            for ip, hits in blocked.items():
+                # log values like 'unknown' or an address with a port can't be blocked, same as in coalesce
+                try:
+                    address = self.pack(ip)
+                except ValueError:
+                    print(f"Skipping invalid address: {ip}")
+                    continue
+                client_id = clients.get(ip)
+                client_id = client_id[0] if isinstance(client_id, list) else client_id
+                self.db.execute('''
+                    insert into blocked values (?, ?, ?, ?, ?, ?, ?)
+                    on conflict (address) do update set last_seen = excluded.last_seen,
+                        hits = hits + excluded.hits, client_id = coalesce(excluded.client_id, client_id),
+                        expires = excluded.expires
+                ''', (address, ip, now, now, hits, client_id, now + self.ttl))
+                self.db.execute('insert into events values (?, ?, ?, ?)', (now, ip, hits, client_id))
+
+    def expire(self):
+        now = time.time()
+        with self.db:
+            expired = self.db.execute('delete from blocked where expires <= ?', (now,)).rowcount
+            self.db.execute('delete from events where time <= ?', (now - self.ttl,))
+        return expired
+
+    def active(self):
+        return [ip for ip, in self.db.execute('select ip from blocked where expires > ? order by address',
+                                              (time.time(),))]
+
+    def contains(self, ip):
+        try:
+            address = self.pack(ip)
+        except ValueError:
+            return False
+        return self.db.execute('select 1 from blocked where address = ? and expires > ?',
+                               (address, time.time())).fetchone() is not None
+
+    def in_range(self, cidr):
+        network = ipaddress.ip_network(cidr, strict=False)
+        return [row for row in self.db.execute(
+            'select ip, first_seen, last_seen, hits, client_id, expires from blocked where address between ? and ?',
+            (self.pack(network.network_address), self.pack(network.broadcast_address)))]
+
+    def import_json(self, path):
+        # one-off migration of the old ip_addresses.json blocklist
+        if not os.path.exists(path) or self.db.execute('select 1 from blocked limit 1').fetchone():
+            return
+        with open(path, 'r') as file:
+            ip_addresses = json.load(file)['ip_addresses']
+        self.block({ip: 0 for ip in ip_addresses}, {})
+
+
+class SlidingWindowCounter:
+    # per-IP request counts over the last `window` seconds, kept in one-second buckets
+    def __init__(self, window):
+        self.window = window
+        self.buckets = deque()
+        self.counts = {}
+
+    def add(self, second, key):
+        if not self.buckets or self.buckets[-1][0] != second:
+            self.buckets.append((second, {}))
+        bucket = self.buckets[-1][1]
+        bucket[key] = bucket.get(key, 0) + 1
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.expire(second)
+        return self.counts[key]
+
+    def expire(self, now):
+        while self.buckets and self.buckets[0][0] <= now - self.window:
+            for key, count in self.buckets.popleft()[1].items():
+                self.counts[key] -= count
+                if not self.counts[key]:
+                    del self.counts[key]
 
 
 class LogProcessor:
-    def __init__(self, es_client, cf_api, ip_addresses_file, json_query_file):
+    fields = ['iP', 'dateTime', 'rejectCode', 'iPCountry', 'clientId']
+    index_prefix = 'api-trace-jet-logs-prod-'
+    threshold = 5
+
+    def __init__(self, es_client, cf_api, blocklist, json_query_file):
         self.es_client = es_client
         self.cf_api = cf_api
-        self.ip_addresses_file = ip_addresses_file
+        self.blocklist = blocklist
         self.json_query_file = json_query_file
 
-    def process_logs(self, zone_id, ruleset_id, rule_id):
-        current_date = datetime.now().strftime('%Y-%m-%d')
-        index = f'api-trace-jet-logs-prod-{current_date}'
-
-        with open(self.ip_addresses_file, "r") as file:
-            ip_addresses_data = json.load(file)
-            ip_addresses = ip_addresses_data["ip_addresses"]
-
+    def load_query(self, start_time, end_time):
         with open(self.json_query_file, "r") as file:
             json_query = json.load(file)
 
-        start_time, end_time = self.get_time_range()
         json_query["query"]["bool"]["filter"][1]["range"]["@timestamp"]["gte"] = start_time
         json_query["query"]["bool"]["filter"][1]["range"]["@timestamp"]["lte"] = end_time
+        return json_query
 
-        result = self.es_client.search(index=index, body=json_query)
+    def get_indices(self, start_time, end_time):
+        # one daily index per date the window touches
+        day = datetime.strptime(start_time[:10], '%Y-%m-%d')
+        last_day = datetime.strptime(end_time[:10], '%Y-%m-%d')
+        indices = []
+        while day <= last_day:
+            indices.append(f"{self.index_prefix}{day.strftime('%Y-%m-%d')}")
+            day += timedelta(days=1)
+        return ','.join(indices)
 
-        print('Logs for the last hour:\n')
+    def count_hits(self, index, json_query, verbose=True):
+        hits = self.es_client.scan(index=index, body=json_query, fields=self.fields)
 
-        ip_list = []
+        ip_counts = {}
         clients = {}
-        for index_info in result['hits']['hits']:
+        for index_info in hits:
             ip_address_list = index_info['fields'].get('iP', [])
             dateTime = index_info['fields'].get('dateTime')
             rejectCode = index_info['fields'].get('rejectCode')
@@ -80,29 +322,173 @@ class LogProcessor:
             clientId = index_info['fields'].get('clientId')
 
             if ip_address_list:
-                ip_list.append(ip_address_list[0])
+                ip_counts[ip_address_list[0]] = ip_counts.get(ip_address_list[0], 0) + 1
                 clients[ip_address_list[0]] = clientId if clientId else None
-            print(f"Datetime: {dateTime}, Country: {iPCountry}, IP: {iP}, ClientID: {clientId if clientId else None}, RejectCode: {rejectCode}")
+            if verbose:
+                print(f"Datetime: {dateTime}, Country: {iPCountry}, IP: {iP}, ClientID: {clientId if clientId else None}, RejectCode: {rejectCode}")
+        return ip_counts, clients
+
+    def count_aggregated(self, index, json_query, verbose=True):
+        buckets = self.es_client.aggregate(index=index, query=json_query["query"], field='iP',
+                                           sub_fields={'clientId': 'clientId', 'iPCountry': 'iPCountry'},
+                                           min_doc_count=self.threshold)
 
         ip_counts = {}
-        for ip_address in ip_list:
-            ip_counts[ip_address] = ip_counts.get(ip_address, 0) + 1
+        clients = {}
+        for bucket in buckets:
+            iP = bucket['key']['key']
+            clientId = next((b['key'] for b in bucket['clientId']['buckets']), None)
+            iPCountry = next((b['key'] for b in bucket['iPCountry']['buckets']), None)
+            ip_counts[iP] = bucket['doc_count']
+            clients[iP] = clientId
+            if verbose:
+                print(f"IP: {iP}, Requests: {bucket['doc_count']}, Country: {iPCountry}, ClientID: {clientId}")
+        return ip_counts, clients
+
+    def over_threshold(self, ip_counts):
+        return {ip_address: count for ip_address, count in ip_counts.items() if count >= self.threshold}
+
+    def select_blocked(self, ip_counts, clients):
+        ip_addresses_to_add = self.over_threshold(ip_counts)
+        for ip_address in ip_addresses_to_add:
+            print(f"Datetime: {datetime.now()}, Blocked: {ip_address}, ClientID: {clients[ip_address]}")
+        return ip_addresses_to_add
+
+    def replay_day(self, day, mode='hits', hours=1):
+        # the same window/count/threshold steps as process_logs, run over one past daily index
+        index = f"{self.index_prefix}{day.strftime('%Y-%m-%d')}"
+        blocked = []
+        window_start = day
+        while window_start < day + timedelta(days=1):
+            window_end = window_start + timedelta(hours=hours)
+            start_time = window_start.strftime("%Y-%m-%dT%H:%M:%S")
+            end_time = window_end.strftime("%Y-%m-%dT%H:%M:%S")
+            json_query = self.load_query(start_time, end_time)
+            if mode == 'aggregate':
+                ip_counts, clients = self.count_aggregated(index, json_query, verbose=False)
+            else:
+                ip_counts, clients = self.count_hits(index, json_query, verbose=False)
+            for ip_address, count in self.over_threshold(ip_counts).items():
+                blocked.append((start_time, ip_address, count, clients.get(ip_address)))
+            window_start = window_end
+        return blocked
+
+    def replay(self, start_date, end_date, mode='hits', hours=1, workers=8, report_file=None):
+        days = []
+        day = datetime.strptime(start_date, '%Y-%m-%d')
+        while day <= datetime.strptime(end_date, '%Y-%m-%d'):
+            days.append(day)
+            day += timedelta(days=1)
+
+        report = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for blocked in executor.map(lambda replay_day: self.replay_day(replay_day, mode, hours), days):
+                for window, ip_address, count, client_id in blocked:
+                    entry = report.setdefault(ip_address, {'first_window': window, 'windows': 0, 'max_requests': 0,
+                                                           'client_id': client_id})
+                    entry['windows'] += 1
+                    entry['max_requests'] = max(entry['max_requests'], count)
+
+        print(f"Replay {start_date}..{end_date}, threshold {self.threshold} per {hours} hour(s): "
+              f"{len(report)} IPs would be blocked")
+        for ip_address, entry in sorted(report.items(), key=lambda item: item[1]['max_requests'], reverse=True):
+            print(f"IP: {ip_address}, Windows: {entry['windows']}, Max requests: {entry['max_requests']}, "
+                  f"First: {entry['first_window']}, ClientID: {entry['client_id']}")
+        if report_file:
+            with open(report_file, 'w') as file:
+                json.dump(report, file, indent=2)
+        return report
+
+    def save_blocked(self, ip_addresses_to_add, clients):
+        self.blocklist.block(ip_addresses_to_add, clients)
+        self.blocklist.expire()
+        return self.blocklist.active()
+
+    def run_daemon(self, zone_id, ruleset_id, rule_id, hours=1, interval=10, lag=5,
+                   checkpoint_file='waf_checkpoint.json'):
+        # poll only documents newer than the checkpoint and keep the hour window in memory
+        window = SlidingWindowCounter(hours * 3600)
+        clients = {}
+        push_pending = False
+        try:
+            with open(checkpoint_file, 'r') as file:
+                checkpoint = json.load(file)['timestamp']
+        except (OSError, ValueError, KeyError):
+            checkpoint = int((time.time() - hours * 3600) * 1000)
+
+        while True:
+            # polls stop --lag seconds behind now; documents indexed later than that after their @timestamp are missed
+            until = int((time.time() - lag) * 1000)
+            if until > checkpoint:
+                start_time = datetime.fromtimestamp(checkpoint / 1000).strftime("%Y-%m-%dT%H:%M:%S")
+                end_time = datetime.fromtimestamp(until / 1000).strftime("%Y-%m-%dT%H:%M:%S")
+                json_query = self.load_query(start_time, end_time)
+                json_query["query"]["bool"]["filter"][1]["range"]["@timestamp"] = {
+                    'gt': checkpoint, 'lte': until, 'format': 'epoch_millis'}
+
+                # the whole poll is read before anything is counted, so a failed poll is retried from the same checkpoint
+                try:
+                    events = []
+                    for index_info in self.es_client.scan(index=self.get_indices(start_time, end_time), body=json_query,
+                                                          fields=self.fields):
+                        ip_address_list = index_info['fields'].get('iP', [])
+                        if ip_address_list:
+                            events.append((index_info['sort'][0], ip_address_list[0], index_info['fields'].get('clientId')))
+                except Exception as e:
+                    print(f"Datetime: {datetime.now()}, Poll failed, retrying from the same checkpoint: {e}")
+                    events = None
+
+                if events is not None:
+                    new_blocked = set()
+                    for timestamp, ip_address, client_id in events:
+                        clients[ip_address] = client_id
+                        # addresses whose block expired from the blocklist are blocked again when they come back
+                        if window.add(timestamp // 1000, ip_address) >= self.threshold and ip_address not in new_blocked \
+                                and not self.blocklist.contains(ip_address):
+                            new_blocked.add(ip_address)
+                    window.expire(until // 1000)
+                    clients = {ip_address: clients[ip_address] for ip_address in window.counts if ip_address in clients}
+
+                    if new_blocked:
+                        new_clients = {ip_address: clients.get(ip_address) for ip_address in new_blocked}
+                        self.save_blocked(self.select_blocked({ip_address: window.counts.get(ip_address, self.threshold)
+                                                               for ip_address in new_blocked}, new_clients), new_clients)
+                        push_pending = True
+
+                    checkpoint = max([checkpoint, until] + [timestamp for timestamp, _, _ in events])
+                    with open(checkpoint_file + '.tmp', 'w') as file:
+                        json.dump({'timestamp': checkpoint}, file)
+                    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+            # expired blocks are lifted at the edge too, not only when a new address gets blocked
+            if self.blocklist.expire():
+                push_pending = True
+
+            # the rule is pushed again on later polls until Cloudflare accepts it
+            if push_pending:
+                try:
+                    self.cf_api.block_ip_addresses(zone_id=zone_id, ruleset_id=ruleset_id, rule_id=rule_id,
+                                                   ip_addresses=self.blocklist.active())
+                    push_pending = False
+                except Exception as e:
+                    print(f"Datetime: {datetime.now()}, Cloudflare update failed, retrying: {e}")
 
-        ip_addresses_to_add = set()
-        with open('ruleset.log', 'a') as file:
-            for ip_address, count in ip_counts.items():
-                if count >= 5:
-                    ip_addresses_to_add.add(ip_address)
-                    log_message = f"Datetime: {datetime.now()}, Blocked: {ip_address}, ClientID: {clients[ip_address]}"
-                    file.write(log_message + '\n')
+            time.sleep(interval)
 
-        with open(self.ip_addresses_file, 'r') as file:
-            data = json.load(file)
-            existing_ip_addresses = set(data['ip_addresses'])
+    def process_logs(self, zone_id, ruleset_id, rule_id, mode='hits', hours=1):
+        start_time, end_time = self.get_time_range(hours)
+        json_query = self.load_query(start_time, end_time)
+        index = self.get_indices(start_time, end_time)
 
-        with open(self.ip_addresses_file, 'w') as file:
-            data['ip_addresses'] = list(existing_ip_addresses.union(ip_addresses_to_add))
-            json.dump(data, file, indent=2)
+        print(f'Logs for the last {hours} hour(s):\n')
+
+        if mode == 'aggregate':
+            ip_counts, clients = self.count_aggregated(index, json_query)
+        else:
+            ip_counts, clients = self.count_hits(index, json_query)
+
+        ip_addresses_to_add = self.select_blocked(ip_counts, clients)
+        ip_addresses = self.save_blocked(ip_addresses_to_add, clients)
 
         self.cf_api.block_ip_addresses(zone_id=zone_id, ruleset_id=ruleset_id, rule_id=rule_id, ip_addresses=ip_addresses)
 
@@ -114,6 +500,22 @@ class LogProcessor:
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Block abusive IPs found in API trace logs')
+    parser.add_argument('--mode', choices=['hits', 'aggregate'], default='hits',
+                        help='Count IPs from raw hits or with an Elasticsearch aggregation')
+    parser.add_argument('--hours', type=int, default=1, help='Size of the time window to scan')
+    parser.add_argument('--daemon', action='store_true', help='Keep running and process new logs every --interval seconds')
+    parser.add_argument('--interval', type=int, default=10, help='Seconds between polls in daemon mode')
+    parser.add_argument('--lag', type=int, default=5,
+                        help='Seconds a daemon poll stays behind now, raise it above the worst ingest delay')
+    parser.add_argument('--replay', nargs=2, metavar=('START', 'END'),
+                        help='Report what would have been blocked between two dates (YYYY-MM-DD), without blocking')
+    parser.add_argument('--workers', type=int, default=8, help='Daily indices replayed in parallel')
+    parser.add_argument('--threshold', type=int, default=LogProcessor.threshold, help='Requests per window that get an IP blocked')
+    parser.add_argument('--query', default='json_query.json', help='Path to the Elasticsearch query file')
+    parser.add_argument('--report', help='Write the replay report to this JSON file')
+    args = parser.parse_args()
+
     load_dotenv('.env')
 
     es_url = os.getenv('ES_URL')
@@ -121,17 +523,44 @@ if __name__ == '__main__':
     es_client = ElasticSearchClient(url=es_url, auth=es_auth)
 
     cf_token = os.getenv('CF_TOKEN')
-    cf_api = CloudflareAPI(token=cf_token)
+    cf_api = CloudflareAPI(
+        token=cf_token,
+        account_id=os.getenv('CF_ACCOUNT_ID'),
+        list_id=os.getenv('CF_LIST_ID'),
+        list_name=os.getenv('CF_LIST_NAME')
+    )
+
+    blocklist = BlocklistStore('blocklist.db', ttl_days=int(os.getenv('BLOCK_TTL_DAYS', 30)))
+    blocklist.import_json('ip_addresses.json')
 
     log_processor = LogProcessor(
         es_client=es_client,
         cf_api=cf_api,
-        ip_addresses_file='ip_addresses.json',
-        json_query_file='json_query.json'
+        blocklist=blocklist,
+        json_query_file=args.query
     )
+    log_processor.threshold = args.threshold
 
-    log_processor.process_logs(
-        zone_id=os.getenv('CF_ZONE_ID'),
-        ruleset_id=os.getenv('CF_RULESET_ID'),
-        rule_id=os.getenv('CF_RULE_ID')
-    )
+    if args.replay:
+        log_processor.replay(args.replay[0], args.replay[1], mode=args.mode, hours=args.hours,
+                             workers=args.workers, report_file=args.report)
+    elif args.daemon:
+        log_processor.run_daemon(
+            zone_id=os.getenv('CF_ZONE_ID'),
+            ruleset_id=os.getenv('CF_RULESET_ID'),
+            rule_id=os.getenv('CF_RULE_ID'),
+            hours=args.hours,
+            interval=args.interval,
+            lag=args.lag
+        )
+    else:
+        try:
+            log_processor.process_logs(
+                zone_id=os.getenv('CF_ZONE_ID'),
+                ruleset_id=os.getenv('CF_RULESET_ID'),
+                rule_id=os.getenv('CF_RULE_ID'),
+                mode=args.mode,
+                hours=args.hours
+            )
+        except CloudflareError as e:
+            sys.exit(f"Blocking failed: {e}")